@@ -0,0 +1,126 @@
+"""
+Per-artist candidate pools built from the artist top-tracks endpoint.
+
+One top-tracks call returns up to 10 full track objects, popularity and
+preview URLs included, which replaces the artist_albums -> album_tracks ->
+track walk. Pools are stored in SQLite with a TTL; a stale pool is still
+served while a background thread refreshes it.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import database
+import shared_budget
+
+POOL_TTL = 24 * 3600
+MARKET = 'US'
+
+# Upstream calls the old albums -> tracks walk needed per artist, used to
+# report how many calls a pool saved
+LEGACY_CALLS_RELATED_ARTIST = 1 + 2 + 6   # artist_albums, 2x album_tracks, 6x track
+LEGACY_CALLS_POPULAR_ARTIST = 1 + 3 + 24  # artist_albums, 3x album_tracks, 24x track
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _connect():
+    return sqlite3.connect(database.DATABASE_FILE, timeout=30)
+
+
+def _compact(track):
+    return {
+        "id": track["id"],
+        "name": track["name"],
+        "artist": track["artists"][0]["name"] if track.get("artists") else "",
+        "album": track["album"]["name"] if track.get("album") else "",
+        "preview_url": track.get("preview_url"),
+        "popularity": track.get("popularity", 0),
+        "duration_ms": track.get("duration_ms", 0),
+        "external_urls": track.get("external_urls", {})
+    }
+
+
+def _fetch(sp, artist_id, artist_name=None, query=None):
+    """One top-tracks call; stores and returns the pool"""
+    results = sp.artist_top_tracks(artist_id, country=MARKET)
+    tracks = [_compact(t) for t in results.get("tracks", []) if t and t.get("id")]
+    tracks.sort(key=lambda t: t["popularity"], reverse=True)
+    if not artist_name and tracks:
+        artist_name = tracks[0]["artist"]
+
+    conn = _connect()
+    with conn:
+        conn.execute('''
+            INSERT INTO artist_pools (artist_id, artist_name, query, tracks, fetched_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(artist_id) DO UPDATE SET
+                artist_name = COALESCE(excluded.artist_name, artist_name),
+                query = COALESCE(excluded.query, query),
+                tracks = excluded.tracks,
+                fetched_at = excluded.fetched_at
+        ''', (artist_id, artist_name, query, json.dumps(tracks), time.time()))
+    conn.close()
+    return tracks
+
+
+def _refresh_in_background(sp, artist_id):
+    with _refreshing_lock:
+        if artist_id in _refreshing:
+            return
+        _refreshing.add(artist_id)
+
+    def run():
+        try:
+            _fetch(sp, artist_id)
+        except Exception as e:
+            logging.warning(f"Background refresh of artist pool {artist_id} failed: {str(e)}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(artist_id)
+
+    threading.Thread(target=run, name=f"artist-pool-{artist_id}", daemon=True).start()
+
+
+def _serve(sp, row, legacy_calls):
+    tracks, fetched_at = json.loads(row[0]), row[1]
+    if time.time() - fetched_at > POOL_TTL:
+        _refresh_in_background(sp, row[2])
+    shared_budget.note_calls_saved(legacy_calls)
+    return tracks
+
+
+def get_artist_pool(sp, artist_id, artist_name=None, legacy_calls=LEGACY_CALLS_RELATED_ARTIST):
+    """Candidate tracks for an artist, most popular first"""
+    conn = _connect()
+    row = conn.execute('SELECT tracks, fetched_at, artist_id FROM artist_pools WHERE artist_id = ?', (artist_id,)).fetchone()
+    conn.close()
+    if row:
+        return _serve(sp, row, legacy_calls)
+
+    tracks = _fetch(sp, artist_id, artist_name)
+    shared_budget.note_calls_saved(legacy_calls - 1)
+    return tracks
+
+
+def get_artist_pool_by_query(sp, query, legacy_calls=LEGACY_CALLS_POPULAR_ARTIST):
+    """
+    Candidate tracks for the artist an artist search for `query` finds. The
+    search itself is skipped once a pool for that query exists.
+    """
+    conn = _connect()
+    row = conn.execute('SELECT tracks, fetched_at, artist_id FROM artist_pools WHERE query = ?', (query,)).fetchone()
+    conn.close()
+    if row:
+        # The artist search is saved as well
+        return _serve(sp, row, legacy_calls + 1)
+
+    artist_results = sp.search(q=query, type="artist", limit=1)
+    artists = artist_results.get("artists", {}).get("items", [])
+    if not artists:
+        return []
+    tracks = _fetch(sp, artists[0]["id"], artists[0].get("name"), query)
+    shared_budget.note_calls_saved(legacy_calls - 1)
+    return tracks
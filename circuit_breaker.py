@@ -0,0 +1,168 @@
+"""
+Per-endpoint circuit breakers for upstream Spotify calls.
+
+closed    -> calls go through; consecutive failures are counted
+open      -> calls fail fast with CircuitOpenError until the recovery timeout passes
+half_open -> a limited number of probe calls go through; a success closes the
+             circuit, a failure opens it again
+"""
+import logging
+import os
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULT_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 3))
+DEFAULT_RECOVERY_SECONDS = float(os.getenv('BREAKER_RECOVERY_SECONDS', 300))
+DEFAULT_HALF_OPEN_PROBES = int(os.getenv('BREAKER_HALF_OPEN_PROBES', 1))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose circuit is open"""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"Circuit '{name}' is open, retry in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Thread-safe circuit breaker for one upstream endpoint"""
+
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 recovery_seconds=DEFAULT_RECOVERY_SECONDS, half_open_probes=DEFAULT_HALF_OPEN_PROBES):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.half_open_probes = half_open_probes
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._counts = {'calls': 0, 'successes': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+        self._last_error = None
+
+    def _current_state(self):
+        """State with the open -> half_open transition applied; caller holds the lock"""
+        if self._state == OPEN and time.time() - self._opened_at >= self.recovery_seconds:
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+        return self._state
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _admit(self):
+        """State a call is admitted under (CLOSED, or HALF_OPEN for a probe), or None"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return CLOSED
+            if state == HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+                self._probes_in_flight += 1
+                return HALF_OPEN
+            self._counts['rejected'] += 1
+            return None
+
+    def allow_request(self):
+        """Whether a call may go upstream right now (reserves a probe slot when half-open)"""
+        return self._admit() is not None
+
+    def record_success(self, probe=False):
+        """
+        Only a successful probe closes the circuit. A slow call admitted while
+        closed that finishes after the circuit opened changes nothing.
+        """
+        with self._lock:
+            self._counts['successes'] += 1
+            state = self._current_state()
+            if state == CLOSED:
+                self._failures = 0
+            elif state == HALF_OPEN and probe:
+                logging.info(f"Circuit '{self.name}' closed after successful probe")
+                self._state = CLOSED
+                self._failures = 0
+                self._probes_in_flight = 0
+
+    def record_failure(self, error=None, probe=False):
+        """
+        Failures count towards opening only while closed; a failed probe
+        reopens a half-open circuit. A slow call admitted while closed that
+        fails after the circuit opened (or went half-open) changes nothing.
+        """
+        with self._lock:
+            self._counts['failures'] += 1
+            self._last_error = str(error) if error else None
+            state = self._current_state()
+            if state == CLOSED:
+                self._failures += 1
+                if self._failures < self.failure_threshold:
+                    return
+            elif not (state == HALF_OPEN and probe):
+                return
+            self._counts['opened'] += 1
+            if state == HALF_OPEN:
+                logging.warning(f"Circuit '{self.name}' reopened after failed probe: {self._last_error}")
+            else:
+                logging.warning(f"Circuit '{self.name}' opened after {self._failures} failures: {self._last_error}")
+            self._state = OPEN
+            self._opened_at = time.time()
+            self._probes_in_flight = 0
+
+    def call(self, func, *args, **kwargs):
+        """Run func through the breaker, raising CircuitOpenError when the circuit is open"""
+        admitted = self._admit()
+        if admitted is None:
+            with self._lock:
+                retry_in = max(0.0, self.recovery_seconds - (time.time() - self._opened_at))
+            raise CircuitOpenError(self.name, retry_in)
+        with self._lock:
+            self._counts['calls'] += 1
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.record_failure(e, probe=admitted == HALF_OPEN)
+            raise
+        self.record_success(probe=admitted == HALF_OPEN)
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            state = self._current_state()
+            retry_in = None
+            if state == OPEN:
+                retry_in = round(max(0.0, self.recovery_seconds - (time.time() - self._opened_at)), 1)
+            return dict(
+                self._counts,
+                state=state,
+                consecutive_failures=self._failures,
+                failure_threshold=self.failure_threshold,
+                recovery_seconds=self.recovery_seconds,
+                retry_in=retry_in,
+                last_error=self._last_error
+            )
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(name, **kwargs):
+    """Process-wide breaker for an endpoint, created on first use"""
+    with _registry_lock:
+        breaker = _registry.get(name)
+        if breaker is None:
+            breaker = _registry[name] = CircuitBreaker(name, **kwargs)
+        return breaker
+
+
+def get_all_status():
+    with _registry_lock:
+        breakers = list(_registry.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
@@ -0,0 +1,254 @@
+"""
+Harmonic and tempo compatibility between tracks, for DJ-style transitions.
+
+A transition from track A to track B is scored from three lookup tables
+built once at import:
+
+- KEY_TABLE      24x24 Camelot-wheel adjacency between (key, mode) pairs
+- TEMPO_TABLE    score by tempo deviation in TEMPO_STEP buckets, after
+                 trying straight, half-time and double-time matching
+- ENERGY_TABLE   score by energy change in ENERGY_STEP buckets; a gentle
+                 rise scores best, drops and big jumps less
+
+Each track's profile merges its saved settings over its audio features:
+`custom_bpm` is the final tempo, otherwise the (saved or upstream) tempo is
+multiplied by `speed`. Like a turntable pitch fader, `speed` also moves the
+key. A saved energy only overrides the features when it is not the settings
+form's default. Components with unknown inputs are left out of the weighted
+score.
+
+score_matrix() scores every ordered pair of a track list in one pass,
+vectorized with numpy.
+"""
+import logging
+import math
+import time
+
+import database
+import feature_matrix
+
+try:
+    import numpy as np
+except ImportError:  # numpy is in requirements.txt; without it score_matrix runs a slower Python loop
+    np = None
+
+WEIGHTS = {'key': 0.4, 'tempo': 0.4, 'energy': 0.2}
+
+# Tempo differences a DJ can absorb by nudging the pitch fader score well
+PITCH_TOLERANCE = 0.06
+TEMPO_STEP = 0.005
+TEMPO_LIMIT = 0.16
+# Half-time / double-time blends work, but a straight match is preferred
+HALF_TIME_FACTOR = 0.9
+TEMPO_MULTIPLIERS = ((1.0, 1.0), (2.0, HALF_TIME_FACTOR), (0.5, HALF_TIME_FACTOR))
+
+ENERGY_STEP = 0.05
+
+MAX_TRACKS = 1000
+
+# Energy the settings form saves when the curator leaves the slider alone
+DEFAULT_SETTINGS_ENERGY = 0.5
+
+
+def _camelot(key, mode):
+    """Camelot number (1-12) and letter for a Spotify key (0 = C) and mode (1 = major)"""
+    # Minor keys share the number of their relative major, three semitones up
+    root = key if mode == 1 else (key + 3) % 12
+    return (7 * root + 7) % 12 + 1, 'B' if mode == 1 else 'A'
+
+
+def _key_pair_score(a, b):
+    number_a, letter_a = _camelot(a // 2, a % 2)
+    number_b, letter_b = _camelot(b // 2, b % 2)
+    steps = min((number_a - number_b) % 12, (number_b - number_a) % 12)
+    if letter_a == letter_b:
+        return {0: 1.0, 1: 0.9, 2: 0.6}.get(steps, 0.1)
+    # Relative major/minor, then the diagonal move one step around the wheel
+    return {0: 0.85, 1: 0.5}.get(steps, 0.1)
+
+
+def _tempo_bucket_score(deviation):
+    if deviation <= 0.01:
+        return 1.0
+    if deviation <= PITCH_TOLERANCE:
+        return 1.0 - 0.4 * (deviation - 0.01) / (PITCH_TOLERANCE - 0.01)
+    return max(0.0, 0.6 * (TEMPO_LIMIT - deviation) / (TEMPO_LIMIT - PITCH_TOLERANCE))
+
+
+def _energy_bucket_score(delta):
+    if 0.0 <= delta <= 0.15:
+        return 1.0
+    if delta > 0.15:
+        return max(0.1, 1.0 - (delta - 0.15) * 1.2)
+    return max(0.1, 1.0 + delta * 1.5)
+
+
+def key_index(key, mode):
+    """Row/column of a (key, mode) pair in KEY_TABLE"""
+    return key * 2 + mode
+
+
+KEY_TABLE = [[_key_pair_score(a, b) for b in range(24)] for a in range(24)]
+TEMPO_TABLE = [_tempo_bucket_score(i * TEMPO_STEP) for i in range(int(round(TEMPO_LIMIT / TEMPO_STEP)) + 1)]
+ENERGY_OFFSET = int(round(1.0 / ENERGY_STEP))
+ENERGY_TABLE = [_energy_bucket_score((i - ENERGY_OFFSET) * ENERGY_STEP) for i in range(2 * ENERGY_OFFSET + 1)]
+
+
+def _merge_profile(features, settings):
+    """Effective tempo, energy and key index of one track"""
+    speed = settings.get('speed') or 1.0
+    if settings.get('custom_bpm'):
+        tempo = settings['custom_bpm']
+    else:
+        base = settings.get('tempo') if settings.get('tempo') is not None else features.get('tempo')
+        tempo = base * speed if base else None
+
+    # The settings form always saves its energy slider, so the untouched
+    # default says nothing about the track
+    energy = settings.get('energy')
+    if energy is None or (energy == DEFAULT_SETTINGS_ENERGY and features.get('energy') is not None):
+        energy = features.get('energy')
+
+    key, mode = features.get('key'), features.get('mode')
+    index = None
+    # Spotify reports key -1 when no key was detected
+    if key is not None and mode is not None and 0 <= key < 12:
+        shift = round(12 * math.log2(speed)) if speed > 0 else 0
+        index = key_index((int(key) + shift) % 12, int(mode))
+    return {'tempo': tempo, 'energy': energy, 'key_index': index}
+
+
+def get_profiles(track_ids):
+    """Merged profiles for many tracks: two bulk reads, no Spotify calls"""
+    features = feature_matrix.get_features_bulk(track_ids)
+    settings = database.get_settings_bulk(track_ids)
+    return {
+        track_id: _merge_profile(features.get(track_id) or {}, settings.get(track_id) or {})
+        for track_id in dict.fromkeys(track_ids)
+    }
+
+
+def _tempo_score(from_tempo, to_tempo):
+    ratio = to_tempo / from_tempo
+    best = 0.0
+    for multiplier, factor in TEMPO_MULTIPLIERS:
+        bucket = int(abs(ratio * multiplier - 1.0) / TEMPO_STEP + 0.5)
+        if bucket < len(TEMPO_TABLE):
+            best = max(best, TEMPO_TABLE[bucket] * factor)
+    return best
+
+
+def pair_score(a, b):
+    """Score in 0..1 for a transition from profile a to profile b, or None when nothing is known"""
+    total = weight = 0.0
+    if a['key_index'] is not None and b['key_index'] is not None:
+        total += WEIGHTS['key'] * KEY_TABLE[a['key_index']][b['key_index']]
+        weight += WEIGHTS['key']
+    if a['tempo'] and b['tempo']:
+        total += WEIGHTS['tempo'] * _tempo_score(a['tempo'], b['tempo'])
+        weight += WEIGHTS['tempo']
+    if a['energy'] is not None and b['energy'] is not None:
+        bucket = int(math.floor((b['energy'] - a['energy']) / ENERGY_STEP + 0.5)) + ENERGY_OFFSET
+        total += WEIGHTS['energy'] * ENERGY_TABLE[min(max(bucket, 0), len(ENERGY_TABLE) - 1)]
+        weight += WEIGHTS['energy']
+    return total / weight if weight else None
+
+
+def _matrix_python(profiles):
+    n = len(profiles)
+    return [[None if i == j else pair_score(profiles[i], profiles[j]) for j in range(n)] for i in range(n)]
+
+
+def _matrix_numpy(profiles):
+    keys = np.array([-1 if p['key_index'] is None else p['key_index'] for p in profiles])
+    tempos = np.array([p['tempo'] or np.nan for p in profiles], dtype=np.float64)
+    energies = np.array([np.nan if p['energy'] is None else p['energy'] for p in profiles], dtype=np.float64)
+
+    total = np.zeros((len(profiles), len(profiles)))
+    weight = np.zeros_like(total)
+
+    known = keys >= 0
+    safe_keys = np.where(known, keys, 0)
+    mask = known[:, None] & known[None, :]
+    total += np.where(mask, WEIGHTS['key'] * np.asarray(KEY_TABLE)[safe_keys[:, None], safe_keys[None, :]], 0.0)
+    weight += mask * WEIGHTS['key']
+
+    known = ~np.isnan(tempos)
+    mask = known[:, None] & known[None, :]
+    safe_tempos = np.where(known, tempos, 1.0)
+    ratio = safe_tempos[None, :] / safe_tempos[:, None]
+    tempo_table = np.append(TEMPO_TABLE, 0.0)  # overflow bucket
+    tempo_scores = np.zeros_like(ratio)
+    for multiplier, factor in TEMPO_MULTIPLIERS:
+        buckets = np.minimum(np.floor(np.abs(ratio * multiplier - 1.0) / TEMPO_STEP + 0.5), len(TEMPO_TABLE)).astype(int)
+        tempo_scores = np.maximum(tempo_scores, tempo_table[buckets] * factor)
+    total += np.where(mask, WEIGHTS['tempo'] * tempo_scores, 0.0)
+    weight += mask * WEIGHTS['tempo']
+
+    known = ~np.isnan(energies)
+    mask = known[:, None] & known[None, :]
+    safe_energies = np.where(known, energies, 0.0)
+    buckets = np.floor((safe_energies[None, :] - safe_energies[:, None]) / ENERGY_STEP + 0.5).astype(int) + ENERGY_OFFSET
+    buckets = np.clip(buckets, 0, len(ENERGY_TABLE) - 1)
+    total += np.where(mask, WEIGHTS['energy'] * np.asarray(ENERGY_TABLE)[buckets], 0.0)
+    weight += mask * WEIGHTS['energy']
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = np.where(weight > 0, total / np.where(weight > 0, weight, 1.0), np.nan)
+    np.fill_diagonal(scores, np.nan)
+    return [[None if math.isnan(value) else float(value) for value in row] for row in scores.tolist()]
+
+
+def score_matrix(track_ids):
+    """
+    Directed scores for every ordered pair: matrix[i][j] rates playing
+    track_ids[j] after track_ids[i] (None on the diagonal and for unknown pairs).
+    """
+    started = time.perf_counter()
+    track_ids = list(dict.fromkeys(track_ids))
+    if len(track_ids) > MAX_TRACKS:
+        raise ValueError(f"At most {MAX_TRACKS} tracks can be scored at once")
+
+    profiles_by_id = get_profiles(track_ids)
+    profiles = [profiles_by_id[track_id] for track_id in track_ids]
+    backend = 'numpy' if np is not None else 'python'
+    matrix = _matrix_numpy(profiles) if np is not None else _matrix_python(profiles)
+    matrix = [[None if score is None else round(score, 4) for score in row] for row in matrix]
+
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+    logging.info(f"Scored {len(track_ids)}x{len(track_ids)} compatibility matrix with {backend} in {elapsed_ms}ms")
+    return {
+        "track_ids": track_ids,
+        "matrix": matrix,
+        "profiled": sum(1 for p in profiles if p['key_index'] is not None or p['tempo'] or p['energy'] is not None),
+        "backend": backend,
+        "elapsed_ms": elapsed_ms
+    }
+
+
+def best_next(result, top=5):
+    """The `top` highest-scoring follow-up tracks of each track in a score_matrix() result"""
+    track_ids = result["track_ids"]
+    best = {}
+    for i, row in enumerate(result["matrix"]):
+        scored = sorted(((score, track_ids[j]) for j, score in enumerate(row) if score is not None), reverse=True)
+        best[track_ids[i]] = [{"id": track_id, "score": round(score, 4)} for score, track_id in scored[:top]]
+    return best
+
+
+def bridge_scores(from_id, to_id, candidate_ids):
+    """
+    How well each candidate sits between two tracks: the mean of the
+    from -> candidate and candidate -> to scores. Unscored candidates are left out.
+    """
+    profiles = get_profiles([from_id, to_id] + list(candidate_ids))
+    scores = {}
+    for candidate_id in candidate_ids:
+        parts = [
+            pair_score(profiles[from_id], profiles[candidate_id]),
+            pair_score(profiles[candidate_id], profiles[to_id])
+        ]
+        parts = [p for p in parts if p is not None]
+        if parts:
+            scores[candidate_id] = sum(parts) / len(parts)
+    return scores
@@ -3,10 +3,14 @@ Database operations for track settings and user data
 """
 import sqlite3
 import logging
+import threading
 from datetime import datetime
 
 DATABASE_FILE = "settings.db"
 
+_schema_lock = threading.Lock()
+_schema_ready = False
+
 def init_database():
     """Initialize the database with required tables"""
     try:
@@ -28,6 +32,130 @@ def init_database():
             )
         ''')
         
+        # Audio features of every track we have seen, used by offline jobs
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS track_catalog (
+                track_id TEXT PRIMARY KEY,
+                track_name TEXT,
+                artist_name TEXT,
+                tempo REAL,
+                energy REAL,
+                danceability REAL,
+                valence REAL,
+                acousticness REAL,
+                loudness REAL,
+                key INTEGER,
+                mode INTEGER,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Preview availability per track and preview yield per search source (preview_index.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS preview_index (
+                track_id TEXT PRIMARY KEY,
+                preview_url TEXT,
+                has_preview INTEGER NOT NULL,
+                checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS preview_sources (
+                source_kind TEXT NOT NULL,
+                source_key TEXT NOT NULL,
+                strategy TEXT,
+                attempts INTEGER DEFAULT 0,
+                tracks_seen INTEGER DEFAULT 0,
+                previews_found INTEGER DEFAULT 0,
+                last_checked TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (source_kind, source_key)
+            )
+        ''')
+        
+        # Background jobs and their completed steps (jobs.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                params TEXT,
+                progress INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                cancel_requested INTEGER DEFAULT 0,
+                owner TEXT,
+                heartbeat_at REAL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS job_steps (
+                job_id TEXT NOT NULL,
+                step INTEGER NOT NULL,
+                result TEXT,
+                PRIMARY KEY (job_id, step)
+            )
+        ''')
+        
+        # Server-side playlist sessions with cached pair transitions and costs (playlist_sessions.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS playlist_sessions (
+                id TEXT PRIMARY KEY,
+                track_ids TEXT NOT NULL,
+                algorithm TEXT,
+                version INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS session_pairs (
+                session_id TEXT NOT NULL,
+                from_id TEXT NOT NULL,
+                to_id TEXT NOT NULL,
+                result TEXT,
+                PRIMARY KEY (session_id, from_id, to_id)
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS session_costs (
+                session_id TEXT NOT NULL,
+                a TEXT NOT NULL,
+                b TEXT NOT NULL,
+                cost REAL,
+                PRIMARY KEY (session_id, a, b)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Per-artist candidate pools from the top-tracks endpoint (artist_pool.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS artist_pools (
+                artist_id TEXT PRIMARY KEY,
+                artist_name TEXT,
+                query TEXT,
+                tracks TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+        ''')
+        
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_artist_pools_query ON artist_pools (query)')
+        
+        # k-nearest-neighbour similarity graph built by similarity_graph.py
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS track_edges (
+                src TEXT NOT NULL,
+                dst TEXT NOT NULL,
+                weight REAL NOT NULL,
+                PRIMARY KEY (src, dst)
+            ) WITHOUT ROWID
+        ''')
+        
         conn.commit()
         conn.close()
         logging.info("Database initialized successfully")
@@ -35,6 +163,14 @@ def init_database():
     except Exception as e:
         logging.error(f"Database initialization failed: {str(e)}")
 
+def ensure_schema():
+    """Run init_database once per process, however many app instances are created"""
+    global _schema_ready
+    with _schema_lock:
+        if not _schema_ready:
+            init_database()
+            _schema_ready = True
+
 def save_track_settings(track_id, settings):
     """Save or update track settings"""
     try:
@@ -105,6 +241,55 @@ def get_track_settings(track_id):
         logging.error(f"Failed to get settings for track {track_id}: {str(e)}")
         return {'tempo': None, 'energy': 0.5, 'custom_bpm': None, 'speed': 1.0, 'notes': ''}
 
+def get_settings_bulk(track_ids):
+    """Saved settings for the given tracks, keyed by track id (tracks without settings are left out)"""
+    track_ids = list(set(track_ids))
+    if not track_ids:
+        return {}
+    try:
+        conn = sqlite3.connect(DATABASE_FILE)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        rows = {}
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(track_ids), 500):
+            chunk = track_ids[start:start + 500]
+            cursor.execute(f'''
+                SELECT track_id, tempo, energy, custom_bpm, speed
+                FROM track_settings 
+                WHERE track_id IN ({','.join('?' * len(chunk))})
+            ''', chunk)
+            for row in cursor.fetchall():
+                rows[row['track_id']] = dict(row)
+        
+        conn.close()
+        return rows
+        
+    except Exception as e:
+        logging.error(f"Failed to get settings in bulk: {str(e)}")
+        return {}
+
+def get_hot_track_ids(limit=20):
+    """Most recently edited tracks, used to pick what to warm at startup"""
+    try:
+        conn = sqlite3.connect(DATABASE_FILE)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT track_id FROM track_settings 
+            ORDER BY updated_at DESC 
+            LIMIT ?
+        ''', (limit,))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        return [row[0] for row in rows]
+        
+    except Exception as e:
+        logging.error(f"Failed to get hot tracks: {str(e)}")
+        return []
+
 def get_all_settings():
     """Get all saved track settings"""
     try:
@@ -139,3 +324,100 @@ def get_all_settings():
     except Exception as e:
         logging.error(f"Failed to get all settings: {str(e)}")
         return []
+
+def save_catalog_track(track_id, features=None, track_name=None, artist_name=None):
+    """Record a track's audio features and/or names in the catalog, keeping known values"""
+    features = features or {}
+    try:
+        conn = sqlite3.connect(DATABASE_FILE)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO track_catalog 
+            (track_id, track_name, artist_name, tempo, energy, danceability, valence, acousticness, loudness, key, mode, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(track_id) DO UPDATE SET
+                track_name = COALESCE(excluded.track_name, track_name),
+                artist_name = COALESCE(excluded.artist_name, artist_name),
+                tempo = COALESCE(excluded.tempo, tempo),
+                energy = COALESCE(excluded.energy, energy),
+                danceability = COALESCE(excluded.danceability, danceability),
+                valence = COALESCE(excluded.valence, valence),
+                acousticness = COALESCE(excluded.acousticness, acousticness),
+                loudness = COALESCE(excluded.loudness, loudness),
+                key = COALESCE(excluded.key, key),
+                mode = COALESCE(excluded.mode, mode),
+                updated_at = excluded.updated_at
+        ''', (
+            track_id,
+            track_name,
+            artist_name,
+            features.get('tempo'),
+            features.get('energy'),
+            features.get('danceability'),
+            features.get('valence'),
+            features.get('acousticness'),
+            features.get('loudness'),
+            features.get('key'),
+            features.get('mode'),
+            datetime.now()
+        ))
+        
+        conn.commit()
+        conn.close()
+        return True
+        
+    except Exception as e:
+        logging.error(f"Failed to catalog track {track_id}: {str(e)}")
+        return False
+
+def get_catalog_features():
+    """All catalogued tracks that have audio features"""
+    try:
+        conn = sqlite3.connect(DATABASE_FILE)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT track_id, track_name, artist_name, tempo, energy, danceability, valence, acousticness, loudness, key, mode
+            FROM track_catalog 
+            WHERE tempo IS NOT NULL AND energy IS NOT NULL
+            ORDER BY track_id
+        ''')
+        
+        rows = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        return rows
+        
+    except Exception as e:
+        logging.error(f"Failed to get catalog features: {str(e)}")
+        return []
+
+def get_catalog_features_for(track_ids):
+    """Catalog rows for the given tracks, keyed by track id (unknown tracks are left out)"""
+    track_ids = list(set(track_ids))
+    if not track_ids:
+        return {}
+    try:
+        conn = sqlite3.connect(DATABASE_FILE)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        
+        rows = {}
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(track_ids), 500):
+            chunk = track_ids[start:start + 500]
+            cursor.execute(f'''
+                SELECT track_id, track_name, artist_name, tempo, energy, danceability, valence, acousticness, loudness, key, mode
+                FROM track_catalog 
+                WHERE track_id IN ({','.join('?' * len(chunk))})
+            ''', chunk)
+            for row in cursor.fetchall():
+                rows[row['track_id']] = dict(row)
+        
+        conn.close()
+        return rows
+        
+    except Exception as e:
+        logging.error(f"Failed to get catalog features: {str(e)}")
+        return {}
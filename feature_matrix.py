@@ -0,0 +1,225 @@
+"""
+Memory-mapped audio-feature matrix shared by every worker process.
+
+Layout of one version, written by build_matrix():
+  features-<version>.ids  sorted track ids, ID_WIDTH ASCII bytes each
+  features-<version>.f32  little-endian float32, one contiguous column per
+                          feature, rows in the same order as the ids (NaN = unknown)
+  CURRENT                 JSON manifest naming the live version
+
+Readers map both files read-only, so all workers share the same page-cache
+pages, and look rows up by binary search over the id file without
+deserializing anything. A reader notices a new CURRENT and switches to it on
+its next lookup; no restart is needed.
+
+Rebuild with:  python feature_matrix.py
+"""
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+import database
+
+try:
+    import numpy as np
+except ImportError:  # row lookups work without numpy; column views need it
+    np = None
+
+MATRIX_DIR = os.getenv('FEATURE_MATRIX_DIR', 'feature_matrix')
+COLUMNS = ['tempo', 'energy', 'danceability', 'valence', 'acousticness', 'loudness', 'key', 'mode']
+ID_WIDTH = 22  # Spotify track ids are 22 base-62 characters
+# How often readers look for a new version
+CHECK_INTERVAL = 2.0
+MANIFEST = 'CURRENT'
+
+
+def _path(name):
+    return os.path.join(MATRIX_DIR, name)
+
+
+def _write_atomic(name, data):
+    tmp = _path(f".{name}.tmp")
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, _path(name))
+
+
+def build_matrix():
+    """Write a new version from the track catalog and make it current"""
+    started = time.perf_counter()
+    rows = [row for row in database.get_catalog_features() if len(row['track_id']) == ID_WIDTH]
+    rows.sort(key=lambda row: row['track_id'])
+    n = len(rows)
+    version = int(time.time() * 1000)
+    os.makedirs(MATRIX_DIR, exist_ok=True)
+
+    ids = b''.join(row['track_id'].encode('ascii') for row in rows)
+    values = array('f')
+    for column in COLUMNS:
+        values.extend(math.nan if row.get(column) is None else float(row[column]) for row in rows)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    data = values.tobytes()
+
+    _write_atomic(f"features-{version}.ids", ids)
+    _write_atomic(f"features-{version}.f32", data)
+    manifest = {"version": version, "rows": n, "columns": COLUMNS, "id_width": ID_WIDTH}
+    _write_atomic(MANIFEST, json.dumps(manifest).encode('utf-8'))
+
+    _remove_old_versions(keep={version, _previous_version(version)})
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+    logging.info(f"Feature matrix v{version} written: {n} tracks in {elapsed_ms}ms")
+    return dict(manifest, elapsed_ms=elapsed_ms)
+
+
+def _versions():
+    found = set()
+    for name in os.listdir(MATRIX_DIR):
+        if name.startswith('features-') and name.endswith(('.ids', '.f32')):
+            try:
+                found.add(int(name[len('features-'):-4]))
+            except ValueError:
+                continue
+    return sorted(found)
+
+
+def _previous_version(version):
+    older = [v for v in _versions() if v < version]
+    return older[-1] if older else None
+
+
+def _remove_old_versions(keep):
+    # The previous version is kept for readers that have not switched yet;
+    # mapped pages of removed files stay valid until those readers let go
+    for version in _versions():
+        if version in keep:
+            continue
+        for suffix in ('.ids', '.f32'):
+            try:
+                os.remove(_path(f"features-{version}{suffix}"))
+            except OSError as e:
+                logging.warning(f"Could not remove old feature matrix file: {str(e)}")
+
+
+class FeatureMatrix:
+    """Read-only view of one matrix version"""
+
+    def __init__(self, manifest):
+        self.version = manifest['version']
+        self.rows = manifest['rows']
+        self.columns = manifest['columns']
+        self.id_width = manifest['id_width']
+        self._column_index = {name: i for i, name in enumerate(self.columns)}
+        self._ids = self._map(f"features-{self.version}.ids")
+        self._data = self._map(f"features-{self.version}.f32")
+
+    def _map(self, name):
+        with open(_path(name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def index_of(self, track_id):
+        """Row number of a track via binary search over the id file, or None"""
+        key = track_id.encode('ascii', 'ignore')
+        if len(key) != self.id_width:
+            return None
+        width, ids = self.id_width, self._ids
+        low, high = 0, self.rows
+        while low < high:
+            mid = (low + high) // 2
+            current = ids[mid * width:(mid + 1) * width]
+            if current < key:
+                low = mid + 1
+            elif current > key:
+                high = mid
+            else:
+                return mid
+        return None
+
+    def value(self, row, column):
+        (value,) = struct.unpack_from('<f', self._data, (self._column_index[column] * self.rows + row) * 4)
+        return None if math.isnan(value) else value
+
+    def get(self, track_id):
+        """Features of one track as a dict, or None when the track is not in the matrix"""
+        row = self.index_of(track_id)
+        if row is None:
+            return None
+        return {column: self.value(row, column) for column in self.columns}
+
+    def column(self, name):
+        """Zero-copy numpy view of one column (requires numpy)"""
+        if np is None:
+            raise RuntimeError("numpy is required for column views")
+        return np.frombuffer(self._data, dtype='<f4', count=self.rows,
+                             offset=self._column_index[name] * self.rows * 4)
+
+
+_reader = None
+_manifest_mtime = None
+_checked_at = 0.0
+_reader_lock = threading.Lock()
+
+
+def get_reader():
+    """Current matrix, reopened when a rebuild has published a new version; None if none exists"""
+    global _reader, _manifest_mtime, _checked_at
+    now = time.time()
+    if now - _checked_at < CHECK_INTERVAL:
+        return _reader
+
+    with _reader_lock:
+        _checked_at = now
+        try:
+            mtime = os.stat(_path(MANIFEST)).st_mtime_ns
+        except OSError:
+            return _reader
+        if mtime == _manifest_mtime and _reader is not None:
+            return _reader
+        try:
+            with open(_path(MANIFEST)) as f:
+                manifest = json.load(f)
+            if _reader is None or manifest['version'] != _reader.version:
+                # The old reader is not closed: requests may still hold it, and
+                # its mapping is released once the last reference goes away
+                _reader = FeatureMatrix(manifest)
+                logging.info(f"Feature matrix v{_reader.version} opened ({_reader.rows} tracks)")
+            _manifest_mtime = mtime
+        except Exception as e:
+            logging.error(f"Failed to open feature matrix: {str(e)}")
+        return _reader
+
+
+def get_features_bulk(track_ids):
+    """
+    Features for many tracks, keyed by track id: matrix rows first, the
+    SQLite catalog for tracks the last rebuild did not include.
+    """
+    reader = get_reader()
+    found = {}
+    missing = []
+    for track_id in set(track_ids):
+        row = reader.get(track_id) if reader else None
+        if row is not None:
+            found[track_id] = row
+        else:
+            missing.append(track_id)
+    if missing:
+        found.update(database.get_catalog_features_for(missing))
+    return found
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    database.ensure_schema()
+    print(build_matrix())
@@ -0,0 +1,235 @@
+"""
+HTTP-level caching for API responses: content-hash ETags, conditional GETs,
+per-route Cache-Control policies and gzip/brotli compression
+"""
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from flask import make_response, request
+
+import database
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# max_age: seconds browsers may reuse the response without asking again
+# server_ttl: seconds the server keeps serving its stored copy (None = until invalidated)
+CachePolicy = namedtuple('CachePolicy', ['max_age', 'public', 'server_ttl'])
+
+POLICIES = {
+    # Audio features practically never change for a given track id
+    'features': CachePolicy(max_age=3600, public=True, server_ttl=3600),
+    # Popular tracks are an expensive snapshot that can be a few minutes old
+    'snapshot': CachePolicy(max_age=300, public=True, server_ttl=600),
+    # User-edited data: clients must revalidate, server copy lives until a write
+    'revalidate': CachePolicy(max_age=0, public=False, server_ttl=None),
+}
+
+MAX_ENTRIES = 512
+# Replaced on every settings write; its identity validates stored settings responses
+SETTINGS_MARKER = os.getenv('SETTINGS_MARKER_FILE', f"{database.DATABASE_FILE}.generation")
+# Views set this header on degraded responses (e.g. placeholder data while
+# Spotify is failing); they are passed through but never stored or reused
+FALLBACK_HEADER = 'X-Fallback'
+COMPRESS_MIN_BYTES = 1024
+
+_entries = OrderedDict()
+_compressed = OrderedDict()
+_lock = threading.Lock()
+_generations = {}
+_stats = {'hits': 0, 'not_modified': 0, 'misses': 0, 'compressed': 0}
+
+
+def compute_etag(body):
+    """Content hash of a response body, used as a weak ETag"""
+    return hashlib.sha1(body).hexdigest()
+
+
+def bump_generation(name):
+    """Mark every cached response tied to `name` as stale"""
+    with _lock:
+        _generations[name] = _generations.get(name, 0) + 1
+
+
+def settings_changed():
+    """
+    Record a settings write: bumps the in-process counter and replaces the
+    marker file so other workers see it. Only save_settings touches the
+    marker; the database file itself is written on many hot paths.
+    """
+    bump_generation('settings')
+    tmp = f"{SETTINGS_MARKER}.tmp"
+    try:
+        with open(tmp, 'w') as f:
+            f.write(str(time.time_ns()))
+        os.replace(tmp, SETTINGS_MARKER)
+    except OSError as e:
+        logging.warning(f"Could not update settings marker: {str(e)}")
+
+
+def settings_generation():
+    """
+    Cheap validator for settings responses: the in-process write counter plus
+    the marker file's identity, so writes from other workers are seen too.
+    Only stats the file - no SQLite work.
+    """
+    try:
+        marker = os.stat(SETTINGS_MARKER)
+        # os.replace gives every write a new inode, even within one mtime tick
+        stamp = (marker.st_ino, marker.st_mtime_ns)
+    except OSError:
+        stamp = None
+    return (_generations.get('settings', 0), stamp)
+
+
+def mark_fallback(response):
+    """Flag a response as degraded so cached_route neither stores it nor lets clients reuse it"""
+    response = make_response(response)
+    response.headers[FALLBACK_HEADER] = '1'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def invalidate(prefix):
+    """Drop stored responses whose request path starts with `prefix`"""
+    with _lock:
+        for key in [k for k in _entries if k.startswith(prefix)]:
+            del _entries[key]
+
+
+def _cache_control(policy):
+    if policy.max_age <= 0:
+        return ('public' if policy.public else 'private') + ', no-cache'
+    return f"{'public' if policy.public else 'private'}, max-age={policy.max_age}"
+
+
+def _finish(body, etag, policy):
+    """Build the final response, answering 304 when the client's copy is current"""
+    if request.if_none_match.contains_weak(etag):
+        _stats['not_modified'] += 1
+        response = make_response('', 304)
+    else:
+        response = make_response(body)
+        response.mimetype = 'application/json'
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = _cache_control(policy)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def cached_route(policy_name, generation=None):
+    """
+    Decorator for GET JSON routes. A stored, still-valid response is checked
+    against If-None-Match before the view runs, so repeat requests never reach
+    Spotify or SQLite. Only 200 responses are stored, and not those marked
+    with mark_fallback().
+
+    `generation` is an optional zero-argument callable; when its value changes
+    the stored response is treated as stale (see settings_generation).
+    """
+    policy = POLICIES[policy_name]
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.full_path
+            gen = generation() if generation else None
+            now = time.time()
+
+            with _lock:
+                entry = _entries.get(key)
+                if entry is not None:
+                    expired = policy.server_ttl is not None and now - entry['stored_at'] > policy.server_ttl
+                    if expired or entry['generation'] != gen:
+                        del _entries[key]
+                        entry = None
+                    else:
+                        _entries.move_to_end(key)
+
+            if entry is not None:
+                _stats['hits'] += 1
+                return _finish(entry['body'], entry['etag'], policy)
+
+            _stats['misses'] += 1
+            response = make_response(view(*args, **kwargs))
+            if (response.status_code != 200
+                    or response.mimetype != 'application/json'
+                    or FALLBACK_HEADER in response.headers):
+                return response
+
+            body = response.get_data()
+            etag = compute_etag(body)
+            with _lock:
+                _entries[key] = {'body': body, 'etag': etag, 'generation': gen, 'stored_at': now}
+                while len(_entries) > MAX_ENTRIES:
+                    _entries.popitem(last=False)
+
+            return _finish(body, etag, policy)
+        return wrapper
+    return decorator
+
+
+def _pick_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_response(response):
+    """after_request hook: compress larger JSON bodies for clients that accept it"""
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+
+    encoding = _pick_encoding()
+    if encoding is None:
+        return response
+
+    # Compressed bodies are keyed by content hash so cached responses only pay once
+    key = (compute_etag(body), encoding)
+    with _lock:
+        compressed = _compressed.get(key)
+        if compressed is not None:
+            _compressed.move_to_end(key)
+
+    if compressed is None:
+        compressed = brotli.compress(body) if encoding == 'br' else gzip.compress(body, compresslevel=6)
+        with _lock:
+            _compressed[key] = compressed
+            while len(_compressed) > MAX_ENTRIES:
+                _compressed.popitem(last=False)
+
+    _stats['compressed'] += 1
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def get_stats():
+    """Counters for the response cache"""
+    with _lock:
+        return dict(_stats, entries=len(_entries), compressed_entries=len(_compressed))
+
+
+def init_app(app):
+    """Register the compression hook on a Flask app"""
+    app.after_request(compress_response)
+    logging.info(f"HTTP cache enabled (brotli {'available' if brotli else 'not installed'})")
@@ -0,0 +1,375 @@
+"""
+Background job queue for long-running transition work.
+
+A job is split into steps (for playlist builds: one step per adjacent track
+pair). Steps run on a bounded process-wide thread pool, at most
+`concurrency` at a time per job, and each finished step is written to SQLite
+straight away so an interrupted job resumes where it stopped after a restart.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import database
+import spotify_client
+import transition_algorithms
+
+MAX_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+# One job may use at most half the pool, so a single client cannot starve the others
+MAX_JOB_CONCURRENCY = max(1, MAX_WORKERS // 2)
+DEFAULT_CONCURRENCY = min(int(os.getenv('JOB_CONCURRENCY', 2)), MAX_JOB_CONCURRENCY)
+# Owners refresh the heartbeat of their unfinished jobs this often, even
+# while a job waits for the pool or runs a long step
+HEARTBEAT_SECONDS = 15
+# Jobs whose owner has not sent a heartbeat for this long are taken over
+STALE_SECONDS = 120
+# How often each worker looks for jobs to take over
+SWEEP_SECONDS = 30
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+TERMINAL = (DONE, FAILED, CANCELLED)
+
+_HOST = socket.gethostname()
+_OWNER = f"{_HOST}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+_executor = None
+_executor_lock = threading.Lock()
+_active = {}
+_active_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='job')
+        return _executor
+
+
+def _connect():
+    return sqlite3.connect(database.DATABASE_FILE, timeout=30)
+
+
+def _update_job(job_id, **fields):
+    fields['updated_at'] = datetime.now()
+    fields['heartbeat_at'] = time.time()
+    columns = ', '.join(f"{name} = ?" for name in fields)
+    conn = _connect()
+    with conn:
+        conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+    conn.close()
+
+
+# --- Transition playlist builds ---------------------------------------------
+
+def _plan_transition_playlist(params):
+    track_ids = params['track_ids']
+    return [(track_ids[i], track_ids[i + 1]) for i in range(len(track_ids) - 1)]
+
+
+def _run_transition_step(params, pair):
+    sp = spotify_client.get_shared_client()
+    if not sp:
+        raise RuntimeError("authentication_failed")
+    if params.get('algorithm') == 'basic':
+        result = transition_algorithms.basic_transition_algorithm(sp, list(pair))
+    else:
+        result = transition_algorithms.smart_transition_algorithm(sp, list(pair))
+    if isinstance(result, tuple):
+        return {"pair": list(pair), "error": result[0].get("error"), "bridges": []}
+    bridges = result.get("suggestions", [])[:params.get('bridges_per_pair', 1)]
+    return {"pair": list(pair), "bridges": bridges}
+
+
+def _finish_transition_playlist(params, step_results):
+    sequence = [params['track_ids'][0]]
+    used = set(params['track_ids'])
+    failed_pairs = []
+    for step in step_results:
+        if step.get("error"):
+            failed_pairs.append(step["pair"])
+        for bridge in step["bridges"]:
+            if bridge["id"] not in used:
+                sequence.append(bridge["id"])
+                used.add(bridge["id"])
+        sequence.append(step["pair"][1])
+    return {"track_ids": sequence, "pairs": step_results, "failed_pairs": failed_pairs}
+
+
+JOB_KINDS = {
+    'transition_playlist': (_plan_transition_playlist, _run_transition_step, _finish_transition_playlist),
+}
+
+
+# --- Scheduling ---------------------------------------------------------------
+
+def _clamp_concurrency(value):
+    return min(max(1, int(value)), MAX_JOB_CONCURRENCY)
+
+
+def _dispatch(job_id, kind, params, done_steps):
+    """Start (or resume) a job, skipping steps that already have results"""
+    conn = _connect()
+    row = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    conn.close()
+    if row and row[0]:
+        _update_job(job_id, status=CANCELLED)
+        return
+
+    plan, run_step, _ = JOB_KINDS[kind]
+    steps = plan(params)
+    pending = [i for i in range(len(steps)) if i not in done_steps]
+    state = {
+        'steps': steps,
+        'pending': pending,
+        'in_flight': 0,
+        'completed': len(steps) - len(pending),
+        'cancelled': False,
+        'concurrency': _clamp_concurrency(params.get('concurrency', DEFAULT_CONCURRENCY)),
+        'lock': threading.Lock(),
+    }
+    with _active_lock:
+        _active[job_id] = state
+
+    _update_job(job_id, status=RUNNING, owner=_OWNER, total=len(steps), progress=state['completed'])
+    if not pending:
+        _finalize(job_id, kind, params)
+        return
+    _fill(job_id, kind, params, state)
+
+
+def _fill(job_id, kind, params, state):
+    """Keep up to `concurrency` steps of this job on the pool"""
+    _, run_step, _ = JOB_KINDS[kind]
+    to_submit = []
+    with state['lock']:
+        while not state['cancelled'] and state['pending'] and state['in_flight'] < state['concurrency']:
+            step = state['pending'].pop(0)
+            state['in_flight'] += 1
+            to_submit.append(step)
+    for step in to_submit:
+        future = _get_executor().submit(run_step, params, state['steps'][step])
+        future.add_done_callback(lambda f, step=step: _on_step_done(job_id, kind, params, state, step, f))
+
+
+def _on_step_done(job_id, kind, params, state, step, future):
+    try:
+        result = future.result()
+    except Exception as e:
+        logging.warning(f"Job {job_id} step {step} failed: {str(e)}")
+        result = {"pair": list(state['steps'][step]), "error": str(e), "bridges": []}
+
+    try:
+        conn = _connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO job_steps (job_id, step, result) VALUES (?, ?, ?)',
+                         (job_id, step, json.dumps(result)))
+            cancel_requested = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        conn.close()
+    except Exception as e:
+        logging.error(f"Job {job_id} could not store step {step}: {str(e)}")
+        cancel_requested = None
+
+    with state['lock']:
+        state['in_flight'] -= 1
+        state['completed'] += 1
+        if cancel_requested and cancel_requested[0]:
+            state['cancelled'] = True
+        finished = state['in_flight'] == 0 and (state['cancelled'] or not state['pending'])
+        completed = state['completed']
+
+    _update_job(job_id, progress=completed)
+    if finished:
+        if state['cancelled']:
+            _update_job(job_id, status=CANCELLED)
+            with _active_lock:
+                _active.pop(job_id, None)
+        else:
+            _finalize(job_id, kind, params)
+    else:
+        _fill(job_id, kind, params, state)
+
+
+def _finalize(job_id, kind, params):
+    _, _, finish = JOB_KINDS[kind]
+    try:
+        step_results = [r for _, r in _load_steps(job_id)]
+        _update_job(job_id, status=DONE, result=json.dumps(finish(params, step_results)))
+    except Exception as e:
+        logging.error(f"Job {job_id} failed to finish: {str(e)}")
+        _update_job(job_id, status=FAILED, error=str(e))
+    finally:
+        with _active_lock:
+            _active.pop(job_id, None)
+
+
+def _load_steps(job_id):
+    conn = _connect()
+    rows = conn.execute('SELECT step, result FROM job_steps WHERE job_id = ? ORDER BY step', (job_id,)).fetchall()
+    conn.close()
+    return [(step, json.loads(result)) for step, result in rows]
+
+
+# --- Public API ---------------------------------------------------------------
+
+def submit_job(kind, params):
+    """Persist a new job and start it on the pool; returns the job id"""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job kind '{kind}'")
+    if int(params.get('bridges_per_pair', 1)) < 0:
+        raise ValueError("bridges_per_pair must not be negative")
+    params = dict(params, concurrency=_clamp_concurrency(params.get('concurrency', DEFAULT_CONCURRENCY)))
+    job_id = uuid.uuid4().hex
+    conn = _connect()
+    with conn:
+        conn.execute('''
+            INSERT INTO jobs (id, kind, status, params, owner, heartbeat_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (job_id, kind, QUEUED, json.dumps(params), _OWNER, time.time(), datetime.now(), datetime.now()))
+    conn.close()
+    _get_executor().submit(_dispatch, job_id, kind, params, set())
+    return job_id
+
+
+def get_job(job_id, include_steps=True):
+    """Job status with partial step results, or None if unknown"""
+    conn = _connect()
+    conn.row_factory = sqlite3.Row
+    row = conn.execute('''
+        SELECT id, kind, status, params, progress, total, result, error, cancel_requested, created_at, updated_at
+        FROM jobs WHERE id = ?
+    ''', (job_id,)).fetchone()
+    conn.close()
+    if not row:
+        return None
+
+    job = dict(row)
+    job['params'] = json.loads(job['params']) if job['params'] else {}
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    job['cancel_requested'] = bool(job['cancel_requested'])
+    if include_steps:
+        job['steps'] = [dict(result, step=step) for step, result in _load_steps(job_id)]
+    return job
+
+
+def cancel_job(job_id):
+    """Request cancellation; steps already running finish, no new ones start"""
+    conn = _connect()
+    with conn:
+        cursor = conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status NOT IN (?, ?, ?)',
+                              (job_id, *TERMINAL))
+        changed = cursor.rowcount
+        # A job still waiting for a worker can be cancelled outright
+        conn.execute('UPDATE jobs SET status = ? WHERE id = ? AND status = ?', (CANCELLED, job_id, QUEUED))
+    conn.close()
+    with _active_lock:
+        state = _active.get(job_id)
+    if state:
+        with state['lock']:
+            state['cancelled'] = True
+    return bool(changed)
+
+
+def _owner_is_dead(owner):
+    """True when `owner` was a process on this host that no longer exists"""
+    try:
+        host, pid, _ = owner.split(':')
+        pid = int(pid)
+    except (AttributeError, ValueError):
+        return False
+    if host != _HOST or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False  # exists, owned by another user
+    return False
+
+
+def resume_jobs():
+    """
+    Claim unfinished jobs whose owner is gone: its heartbeat is older than
+    STALE_SECONDS, or it was a process on this host that has exited. Each
+    claim is a compare-and-swap on the owner and heartbeat that were read, so
+    several workers sweeping together never run the same job twice.
+    """
+    cutoff = time.time() - STALE_SECONDS
+    conn = _connect()
+    with conn:
+        rows = conn.execute('''
+            SELECT id, kind, params, cancel_requested, owner, heartbeat_at FROM jobs
+            WHERE status IN (?, ?) AND (owner IS NULL OR owner != ?)
+        ''', (QUEUED, RUNNING, _OWNER)).fetchall()
+        claimed = []
+        for job_id, kind, params, cancel_requested, owner, heartbeat_at in rows:
+            stale = heartbeat_at is None or heartbeat_at < cutoff
+            if not stale and not _owner_is_dead(owner):
+                continue
+            cursor = conn.execute('''
+                UPDATE jobs SET owner = ?, heartbeat_at = ?
+                WHERE id = ? AND owner IS ? AND heartbeat_at IS ?
+            ''', (_OWNER, time.time(), job_id, owner, heartbeat_at))
+            if cursor.rowcount:
+                claimed.append((job_id, kind, json.loads(params), cancel_requested))
+    conn.close()
+
+    for job_id, kind, params, cancel_requested in claimed:
+        if cancel_requested or kind not in JOB_KINDS:
+            _update_job(job_id, status=CANCELLED)
+            continue
+        done_steps = {step for step, _ in _load_steps(job_id)}
+        logging.info(f"Resuming job {job_id} with {len(done_steps)} steps already done")
+        _get_executor().submit(_dispatch, job_id, kind, params, done_steps)
+    return len(claimed)
+
+
+def _heartbeat():
+    """Refresh the heartbeat of every unfinished job this process owns"""
+    conn = _connect()
+    with conn:
+        conn.execute('UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status IN (?, ?)',
+                     (time.time(), _OWNER, QUEUED, RUNNING))
+    conn.close()
+
+
+_maintenance = None
+_maintenance_lock = threading.Lock()
+
+
+def _maintenance_loop(stop):
+    last_sweep = time.time()
+    while not stop.wait(HEARTBEAT_SECONDS):
+        try:
+            _heartbeat()
+            if time.time() - last_sweep >= SWEEP_SECONDS:
+                last_sweep = time.time()
+                resume_jobs()
+        except Exception as e:
+            logging.error(f"Job maintenance failed: {str(e)}")
+
+
+def start_maintenance():
+    """
+    Resume orphaned jobs now, then keep heartbeating owned jobs and sweeping
+    for orphaned ones in a background thread (once per process).
+    """
+    global _maintenance
+    with _maintenance_lock:
+        if _maintenance is not None:
+            return 0
+        resumed = resume_jobs()
+        _maintenance = threading.Event()
+        threading.Thread(target=_maintenance_loop, args=(_maintenance,), name='job-maintenance', daemon=True).start()
+    return resumed
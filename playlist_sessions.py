@@ -0,0 +1,242 @@
+"""
+Server-side playlist sessions for incremental re-ranking.
+
+A session stores the playlist order, the transition result for every adjacent
+pair and a symmetric feature-space cost matrix between its tracks. Edits
+arrive as a list of operations; afterwards only pairs that were not adjacent
+before are sent to the transition algorithm, and only cost entries involving
+inserted tracks are computed. Everything else is reused.
+"""
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from datetime import datetime
+
+import database
+import feature_matrix
+import similarity_graph
+import spotify_client
+import transition_algorithms
+
+SUGGESTIONS_PER_PAIR = 3
+
+
+class SessionConflict(Exception):
+    """The session changed since the version the edit was based on"""
+
+
+def _connect():
+    return sqlite3.connect(database.DATABASE_FILE, timeout=30)
+
+
+def apply_edits(track_ids, ops):
+    """
+    Apply edit operations in order and return the new track list. Supported:
+    {"op": "insert", "index": i, "track_id": id}, {"op": "remove", "index": i}
+    and {"op": "move", "from": i, "to": j}.
+    """
+    track_ids = list(track_ids)
+    for op in ops:
+        kind = op.get('op')
+        if kind == 'insert':
+            index = int(op.get('index', len(track_ids)))
+            if not op.get('track_id') or not 0 <= index <= len(track_ids):
+                raise ValueError(f"Invalid insert: {op}")
+            track_ids.insert(index, op['track_id'])
+        elif kind == 'remove':
+            index = int(op.get('index', -1))
+            if not 0 <= index < len(track_ids):
+                raise ValueError(f"Invalid remove: {op}")
+            track_ids.pop(index)
+        elif kind == 'move':
+            source, target = int(op.get('from', -1)), int(op.get('to', -1))
+            if not (0 <= source < len(track_ids) and 0 <= target < len(track_ids)):
+                raise ValueError(f"Invalid move: {op}")
+            track_ids.insert(target, track_ids.pop(source))
+        else:
+            raise ValueError(f"Unknown edit operation: {op}")
+    return track_ids
+
+
+def _adjacent_pairs(track_ids):
+    return [(track_ids[i], track_ids[i + 1]) for i in range(len(track_ids) - 1)]
+
+
+def _compute_pair(sp, algorithm, pair):
+    if algorithm == 'basic':
+        result = transition_algorithms.basic_transition_algorithm(sp, list(pair))
+    else:
+        result = transition_algorithms.smart_transition_algorithm(sp, list(pair))
+    if isinstance(result, tuple):
+        return {"error": result[0].get("error"), "suggestions": []}
+    return {"suggestions": result.get("suggestions", [])[:SUGGESTIONS_PER_PAIR]}
+
+
+def _cost_key(a, b):
+    return (a, b) if a <= b else (b, a)
+
+
+def _update_costs(conn, session_id, old_ids, new_ids):
+    """
+    Bring the stored cost matrix in line with the new track set: drop entries
+    of removed tracks and add the row of each inserted track. Reordering
+    touches nothing. Returns (entries_computed, entries_removed).
+    """
+    old_set, new_set = set(old_ids), set(new_ids)
+    removed = old_set - new_set
+    added = new_set - old_set
+
+    for track_id in removed:
+        conn.execute('DELETE FROM session_costs WHERE session_id = ? AND (a = ? OR b = ?)',
+                     (session_id, track_id, track_id))
+    if not added:
+        return 0, len(removed)
+
+    features = feature_matrix.get_features_bulk(new_set)
+    vectors = {track_id: similarity_graph.feature_vector(row) for track_id, row in features.items()}
+    entries = {}
+    for track_id in added:
+        for other in new_set:
+            if other == track_id:
+                continue
+            key = _cost_key(track_id, other)
+            if key in entries:
+                continue
+            if track_id in vectors and other in vectors:
+                entries[key] = similarity_graph.distance(vectors[track_id], vectors[other])
+            else:
+                entries[key] = None
+    conn.executemany('INSERT OR REPLACE INTO session_costs (session_id, a, b, cost) VALUES (?, ?, ?, ?)',
+                     [(session_id, a, b, cost) for (a, b), cost in entries.items()])
+    return len(entries), len(removed)
+
+
+def _adjacent_costs(conn, session_id, pairs):
+    costs = []
+    for a, b in pairs:
+        key = _cost_key(a, b)
+        row = conn.execute('SELECT cost FROM session_costs WHERE session_id = ? AND a = ? AND b = ?',
+                           (session_id, *key)).fetchone()
+        costs.append(round(row[0], 4) if row and row[0] is not None else None)
+    return costs
+
+
+def _sync(session_id, algorithm, old_ids, new_ids, version, stats):
+    """Recompute what the edit invalidated and persist the new state"""
+    started = time.perf_counter()
+    conn = _connect()
+    try:
+        stored = {
+            (from_id, to_id): json.loads(result)
+            for from_id, to_id, result in conn.execute(
+                'SELECT from_id, to_id, result FROM session_pairs WHERE session_id = ?', (session_id,)
+            )
+        }
+        pairs = _adjacent_pairs(new_ids)
+        missing = [pair for pair in dict.fromkeys(pairs) if pair not in stored]
+
+        # Upstream work happens outside any transaction
+        if missing:
+            sp = spotify_client.get_shared_client()
+            if not sp:
+                raise RuntimeError("authentication_failed")
+            for pair in missing:
+                stored[pair] = _compute_pair(sp, algorithm, pair)
+
+        with conn:
+            # The version bump is the transaction's first write and a
+            # compare-and-swap, so of two concurrent edits only one can win
+            if version == 0:
+                conn.execute('INSERT INTO playlist_sessions (id, track_ids, algorithm, version, updated_at) VALUES (?, ?, ?, ?, ?)',
+                             (session_id, json.dumps(new_ids), algorithm, 1, datetime.now()))
+            else:
+                cursor = conn.execute('''
+                    UPDATE playlist_sessions SET track_ids = ?, version = version + 1, updated_at = ?
+                    WHERE id = ? AND version = ?
+                ''', (json.dumps(new_ids), datetime.now(), session_id, version))
+                if cursor.rowcount == 0:
+                    raise SessionConflict(f"Session {session_id} changed while the edit was being applied")
+
+            entries_computed, entries_removed = _update_costs(conn, session_id, old_ids, new_ids)
+            adjacent = set(pairs)
+            conn.execute('DELETE FROM session_pairs WHERE session_id = ?', (session_id,))
+            conn.executemany('INSERT INTO session_pairs (session_id, from_id, to_id, result) VALUES (?, ?, ?, ?)',
+                             [(session_id, a, b, json.dumps(stored[(a, b)])) for a, b in adjacent])
+            costs = _adjacent_costs(conn, session_id, pairs)
+    finally:
+        conn.close()
+
+    n = len(set(new_ids))
+    total_entries = n * (n - 1) // 2
+    stats.update({
+        "pairs_total": len(pairs),
+        "pairs_computed": len(missing),
+        "pairs_reused": len(pairs) - sum(1 for pair in pairs if pair in missing),
+        "cost_entries_total": total_entries,
+        "cost_entries_computed": entries_computed,
+        "cost_entries_reused": total_entries - entries_computed,
+        "cost_entries_removed": entries_removed,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)
+    })
+    return {
+        "session_id": session_id,
+        "version": version + 1,
+        "track_ids": new_ids,
+        "pairs": [dict(stored[pair], **{"from": pair[0], "to": pair[1], "cost": cost}) for pair, cost in zip(pairs, costs)],
+        "total_cost": round(sum(c for c in costs if c is not None), 4),
+        "stats": stats
+    }
+
+
+def create_session(track_ids, algorithm='smart'):
+    """Start a session; every pair and cost entry is computed once here"""
+    session_id = uuid.uuid4().hex
+    return _sync(session_id, algorithm, [], list(track_ids), 0, {"ops": 0})
+
+
+def get_session(session_id):
+    conn = _connect()
+    row = conn.execute('SELECT track_ids, algorithm, version FROM playlist_sessions WHERE id = ?', (session_id,)).fetchone()
+    if not row:
+        conn.close()
+        return None
+    track_ids = json.loads(row[0])
+    pairs = _adjacent_pairs(track_ids)
+    stored = {
+        (from_id, to_id): json.loads(result)
+        for from_id, to_id, result in conn.execute(
+            'SELECT from_id, to_id, result FROM session_pairs WHERE session_id = ?', (session_id,)
+        )
+    }
+    costs = _adjacent_costs(conn, session_id, pairs)
+    conn.close()
+    return {
+        "session_id": session_id,
+        "version": row[2],
+        "algorithm": row[1],
+        "track_ids": track_ids,
+        "pairs": [dict(stored.get(pair, {}), **{"from": pair[0], "to": pair[1], "cost": cost}) for pair, cost in zip(pairs, costs)],
+        "total_cost": round(sum(c for c in costs if c is not None), 4)
+    }
+
+
+def edit_session(session_id, ops, base_version=None):
+    """
+    Apply edits and recompute only what they invalidated. Pass `base_version`
+    (the version the client edited) to reject edits made against stale state.
+    """
+    conn = _connect()
+    row = conn.execute('SELECT track_ids, algorithm, version FROM playlist_sessions WHERE id = ?', (session_id,)).fetchone()
+    conn.close()
+    if not row:
+        return None
+
+    old_ids, algorithm, version = json.loads(row[0]), row[1], row[2]
+    if base_version is not None and int(base_version) != version:
+        raise SessionConflict(f"Session is at version {version}, edit was based on {base_version}")
+
+    new_ids = apply_edits(old_ids, ops)
+    logging.info(f"Session {session_id}: {len(ops)} edits, {len(old_ids)} -> {len(new_ids)} tracks")
+    return _sync(session_id, algorithm, old_ids, new_ids, version, {"ops": len(ops)})
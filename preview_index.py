@@ -0,0 +1,241 @@
+"""
+Preview-availability index: remembers which tracks have a 30s preview, keeps a
+Bloom filter of tracks known to have none, and tracks the preview yield of
+every search source (query, playlist, artist, album) so preview hunting can
+skip dead ends and try productive sources first.
+"""
+import hashlib
+import logging
+import math
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import database
+
+# Negatives and empty sources are re-checked after this long
+NEGATIVE_TTL = timedelta(days=7)
+# A source is "known empty" after this many attempts without a single preview
+EMPTY_SOURCE_ATTEMPTS = 2
+# Positive lookups kept in memory
+MAX_POSITIVES = 50000
+# How often the Bloom filter is rebuilt from the table (drops expired negatives)
+REBUILD_INTERVAL = 3600
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings using double hashing"""
+
+    def __init__(self, capacity=100000, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.md5(item.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+_lock = threading.Lock()
+_positives = {}
+_negatives = None
+_sources = None
+_loaded_at = 0.0
+_stats = {'lookups': 0, 'hits_positive': 0, 'hits_negative': 0, 'misses': 0}
+
+
+def _connect():
+    return sqlite3.connect(database.DATABASE_FILE)
+
+
+def _load():
+    """(Re)build the in-memory views from the table; caller holds _lock"""
+    global _negatives, _sources, _loaded_at
+    cutoff = datetime.now() - NEGATIVE_TTL
+    try:
+        conn = _connect()
+        negatives = conn.execute(
+            'SELECT track_id FROM preview_index WHERE has_preview = 0 AND checked_at >= ?', (cutoff,)
+        ).fetchall()
+        positives = conn.execute(
+            'SELECT track_id, preview_url FROM preview_index WHERE has_preview = 1 ORDER BY checked_at DESC LIMIT ?',
+            (MAX_POSITIVES,)
+        ).fetchall()
+        sources = conn.execute(
+            'SELECT source_kind, source_key, strategy, attempts, tracks_seen, previews_found, last_checked FROM preview_sources'
+        ).fetchall()
+        conn.close()
+    except Exception as e:
+        logging.error(f"Failed to load preview index: {str(e)}")
+        negatives, positives, sources = [], [], []
+
+    _negatives = BloomFilter(capacity=max(100000, len(negatives) * 2))
+    for (track_id,) in negatives:
+        _negatives.add(track_id)
+    _positives.clear()
+    _positives.update(positives)
+    _sources = {
+        (kind, key): {'strategy': strategy, 'attempts': attempts, 'tracks_seen': seen,
+                      'previews_found': found, 'last_checked': str(checked)}
+        for kind, key, strategy, attempts, seen, found, checked in sources
+    }
+    _loaded_at = time.time()
+
+
+def _ensure_loaded():
+    if _negatives is None or time.time() - _loaded_at > REBUILD_INTERVAL:
+        _load()
+
+
+def _lookup(track_id):
+    """lookup() body; caller holds _lock"""
+    _stats['lookups'] += 1
+    if track_id in _positives:
+        _stats['hits_positive'] += 1
+        return True
+    if track_id in _negatives:
+        _stats['hits_negative'] += 1
+        return False
+    _stats['misses'] += 1
+    return None
+
+
+def lookup(track_id):
+    """True/False when preview availability is known, None when it has to be fetched"""
+    with _lock:
+        _ensure_loaded()
+        return _lookup(track_id)
+
+
+def record_tracks(tracks, strategy=None, source_kind=None, source_key=None):
+    """
+    Record preview availability for track dicts (raw Spotify objects or our
+    own suggestion dicts - both carry `id` and `preview_url`) and credit the
+    source they came from.
+    """
+    tracks = [t for t in tracks if t and t.get('id')]
+    now = datetime.now()
+    previews = sum(1 for t in tracks if t.get('preview_url'))
+
+    with _lock:
+        _ensure_loaded()
+        for track in tracks:
+            if track.get('preview_url'):
+                _positives[track['id']] = track['preview_url']
+            else:
+                _positives.pop(track['id'], None)
+                _negatives.add(track['id'])
+        if source_kind and source_key:
+            source = _sources.setdefault((source_kind, source_key), {
+                'strategy': strategy, 'attempts': 0, 'tracks_seen': 0, 'previews_found': 0
+            })
+            source['attempts'] += 1
+            source['tracks_seen'] += len(tracks)
+            source['previews_found'] += previews
+            source['last_checked'] = str(now)
+
+    try:
+        conn = _connect()
+        with conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO preview_index (track_id, preview_url, has_preview, checked_at)
+                VALUES (?, ?, ?, ?)
+            ''', [(t['id'], t.get('preview_url'), 1 if t.get('preview_url') else 0, now) for t in tracks])
+            if source_kind and source_key:
+                conn.execute('''
+                    INSERT INTO preview_sources (source_kind, source_key, strategy, attempts, tracks_seen, previews_found, last_checked)
+                    VALUES (?, ?, ?, 1, ?, ?, ?)
+                    ON CONFLICT(source_kind, source_key) DO UPDATE SET
+                        strategy = COALESCE(excluded.strategy, strategy),
+                        attempts = attempts + 1,
+                        tracks_seen = tracks_seen + excluded.tracks_seen,
+                        previews_found = previews_found + excluded.previews_found,
+                        last_checked = excluded.last_checked
+                ''', (source_kind, source_key, strategy, len(tracks), previews, now))
+        conn.close()
+    except Exception as e:
+        logging.error(f"Failed to record preview availability: {str(e)}")
+
+
+def _source_yield(source):
+    return source['previews_found'] / source['tracks_seen'] if source['tracks_seen'] else 0.0
+
+
+def is_known_empty(source_kind, source_key):
+    """True when a source has repeatedly produced no previews within the TTL"""
+    with _lock:
+        _ensure_loaded()
+        source = _sources.get((source_kind, source_key))
+    if not source or source['previews_found'] or source['attempts'] < EMPTY_SOURCE_ATTEMPTS:
+        return False
+    try:
+        return datetime.fromisoformat(source['last_checked']) >= datetime.now() - NEGATIVE_TTL
+    except (TypeError, ValueError):
+        return False
+
+
+def rank_sources(source_kind, keys):
+    """
+    Order sources by preview yield, with known-empty sources demoted to the
+    end rather than dropped, so a strategy always has something to run even
+    when every source has gone dry. Sources with no history keep their
+    original position relative to each other and rank alongside an average
+    yield, so new queries still get tried.
+    """
+    with _lock:
+        _ensure_loaded()
+        known = {key: _sources.get((source_kind, key)) for key in keys}
+    seen = [s for s in known.values() if s and s['tracks_seen']]
+    prior = sum(_source_yield(s) for s in seen) / len(seen) if seen else 0.0
+
+    ranked = []
+    for position, key in enumerate(keys):
+        source = known[key]
+        score = _source_yield(source) if source and source['tracks_seen'] else prior
+        ranked.append((is_known_empty(source_kind, key), -score, position, key))
+    ranked.sort()
+    return [key for _, _, _, key in ranked]
+
+
+def fill_previews(tracks):
+    """Fill missing preview URLs from the index (used before sorting on preview availability)"""
+    with _lock:
+        _ensure_loaded()
+        for track in tracks:
+            if not track.get('preview_url') and track.get('id') and _lookup(track['id']):
+                track['preview_url'] = _positives[track['id']]
+    return tracks
+
+
+def get_stats():
+    """Hit rates of the index and preview yield per strategy"""
+    with _lock:
+        _ensure_loaded()
+        stats = dict(_stats)
+        stats['positives_cached'] = len(_positives)
+        stats['negatives_cached'] = _negatives.count
+        strategies = {}
+        for source in _sources.values():
+            entry = strategies.setdefault(source['strategy'] or 'unknown', {'sources': 0, 'tracks_seen': 0, 'previews_found': 0})
+            entry['sources'] += 1
+            entry['tracks_seen'] += source['tracks_seen']
+            entry['previews_found'] += source['previews_found']
+
+    lookups = stats['lookups'] or 1
+    stats['hit_rate'] = round((stats['hits_positive'] + stats['hits_negative']) / lookups, 4)
+    for entry in strategies.values():
+        entry['preview_yield'] = round(_source_yield(entry), 4)
+    stats['strategies'] = strategies
+    return stats
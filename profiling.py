@@ -0,0 +1,203 @@
+"""
+Opt-in per-request profiling.
+
+A request is profiled when it carries `X-Profile-Token` matching PROFILE_TOKEN,
+or at random with probability PROFILE_SAMPLE_RATE. A sampler thread records
+the request thread's stack every PROFILE_INTERVAL seconds, plus the stacks
+of helper threads working for it (see attached()), and writes the
+samples as collapsed stacks (`*.folded`, readable by flamegraph.pl and
+speedscope) to PROFILE_DIR, keeping the newest PROFILE_KEEP files.
+
+When neither setting is configured no hooks are registered and tag() returns
+immediately, so there is no per-request cost.
+"""
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request
+
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 50))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.005))
+
+# thread id -> current span name, only populated while that thread is profiled
+_spans = {}
+_profiled_threads = set()
+# request thread id -> its sampler, so helper threads can join the profile
+_samplers = {}
+
+
+def tag(name):
+    """Label the following samples of this thread (e.g. the current strategy)"""
+    if not _profiled_threads:
+        return
+    thread_id = threading.get_ident()
+    if thread_id in _profiled_threads:
+        _spans[thread_id] = name
+
+
+def context():
+    """
+    Profiling context of this thread, to hand to helper threads that do work
+    for the current request (see attached()); None when it is not profiled.
+    """
+    if not _profiled_threads:
+        return None
+    thread_id = threading.get_ident()
+    sampler = _samplers.get(thread_id)
+    if sampler is None:
+        return None
+    return sampler, _spans.get(thread_id)
+
+
+@contextmanager
+def attached(ctx):
+    """Sample this helper thread into the request profile `ctx` while the block runs"""
+    if ctx is None:
+        yield
+        return
+    sampler, span = ctx
+    thread_id = threading.get_ident()
+    _profiled_threads.add(thread_id)
+    if span:
+        _spans[thread_id] = span
+    sampler.add_thread(thread_id)
+    try:
+        yield
+    finally:
+        sampler.remove_thread(thread_id)
+        _profiled_threads.discard(thread_id)
+        _spans.pop(thread_id, None)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _Sampler(threading.Thread):
+    """Samples a request thread's stack, and those of its attached helper threads, at a fixed interval"""
+
+    def __init__(self, thread_id, root, interval):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.root = root
+        self.interval = interval
+        self.samples = Counter()
+        self._helpers = {}
+        self._stop_event = threading.Event()
+
+    def add_thread(self, thread_id):
+        self._helpers[thread_id] = threading.current_thread().name
+
+    def remove_thread(self, thread_id):
+        self._helpers.pop(thread_id, None)
+
+    def _sample(self, frames, thread_id, label=None):
+        frame = frames.get(thread_id)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        stack.reverse()
+        span = _spans.get(thread_id)
+        prefix = [self.root] + ([f"span:{span}"] if span else []) + ([f"thread:{label}"] if label else [])
+        self.samples[';'.join(prefix + stack)] += 1
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            self._sample(frames, self.thread_id)
+            for thread_id, name in list(self._helpers.items()):
+                self._sample(frames, thread_id, name)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _should_profile():
+    token = request.headers.get('X-Profile-Token')
+    if PROFILE_TOKEN and token and hmac.compare_digest(token, PROFILE_TOKEN):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _start_profile():
+    if not _should_profile():
+        return
+    thread_id = threading.get_ident()
+    _profiled_threads.add(thread_id)
+    sampler = _Sampler(thread_id, f"route:{request.method} {request.path}", PROFILE_INTERVAL)
+    _samplers[thread_id] = sampler
+    g.profile = {'sampler': sampler, 'started': time.time()}
+    sampler.start()
+
+
+def _prune():
+    files = sorted(
+        (os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR) if name.endswith('.folded')),
+        key=os.path.getmtime
+    )
+    for path in files[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else files:
+        os.remove(path)
+
+
+def _finish_profile():
+    """Stop sampling and write the profile; returns the file name or None"""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return None
+    sampler = profile['sampler']
+    sampler.stop()
+    _profiled_threads.discard(sampler.thread_id)
+    _spans.pop(sampler.thread_id, None)
+    _samplers.pop(sampler.thread_id, None)
+
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.folded"
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, name), 'w') as f:
+            for stack, count in sampler.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        _prune()
+        elapsed_ms = (time.time() - profile['started']) * 1000
+        logging.info(f"Profiled {sampler.root} ({elapsed_ms:.0f}ms, {sum(sampler.samples.values())} samples) -> {name}")
+        return name
+    except OSError as e:
+        logging.error(f"Failed to write profile: {str(e)}")
+        return None
+
+
+def _after_request(response):
+    name = _finish_profile()
+    if name:
+        response.headers['X-Profile-File'] = name
+    return response
+
+
+def _teardown_request(exc):
+    # Covers requests that raised before after_request ran
+    _finish_profile()
+
+
+def init_app(app):
+    """Register profiling hooks only when profiling is configured"""
+    if not PROFILE_TOKEN and PROFILE_SAMPLE_RATE <= 0:
+        return
+    app.before_request(_start_profile)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    logging.info(f"Request profiling enabled (sample rate {PROFILE_SAMPLE_RATE}, token {'set' if PROFILE_TOKEN else 'unset'})")
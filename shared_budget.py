@@ -0,0 +1,300 @@
+"""
+Host-level coordination between worker processes, backed by a small SQLite
+file so no external service is needed:
+
+- one client-credentials access token shared by every worker
+- one global request budget (token bucket) with fair sharing between the
+  workers that are currently active
+- a shared backoff: when any worker gets a 429 with Retry-After, every
+  worker waits it out
+"""
+import json
+import logging
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+import spotipy
+import urllib3
+from spotipy.cache_handler import CacheHandler
+from spotipy.exceptions import SpotifyException
+from spotipy.oauth2 import SpotifyClientCredentials
+
+COORDINATION_FILE = os.getenv('COORDINATION_DB', 'coordination.db')
+RATE_PER_SECOND = float(os.getenv('SPOTIFY_RATE_PER_SECOND', 5))
+RATE_BURST = float(os.getenv('SPOTIFY_RATE_BURST', 10))
+# Longest a call waits for budget before going ahead anyway
+MAX_WAIT_SECONDS = 30.0
+# Workers that made a request this recently count towards fair sharing
+ACTIVE_WORKER_SECONDS = 30.0
+MAX_429_RETRIES = 2
+DEFAULT_RETRY_AFTER = 5.0
+
+
+_request_calls = threading.local()
+
+
+def reset_request_calls():
+    """Start counting upstream calls made by this thread (one request)"""
+    _request_calls.calls = 0
+    _request_calls.saved = 0
+
+
+def note_calls_saved(count):
+    """Record upstream calls a cache made unnecessary for the current request"""
+    _request_calls.saved = getattr(_request_calls, 'saved', 0) + count
+
+
+def add_request_calls(count):
+    """Credit upstream calls made on a helper thread to the current request"""
+    _request_calls.calls = getattr(_request_calls, 'calls', 0) + count
+
+
+def request_calls():
+    """Upstream calls made and saved by this thread since reset_request_calls()"""
+    return {
+        "upstream_calls": getattr(_request_calls, 'calls', 0),
+        "upstream_calls_saved": getattr(_request_calls, 'saved', 0)
+    }
+
+
+def _worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+_schema_ready = False
+
+
+def _connect():
+    global _schema_ready
+    conn = sqlite3.connect(COORDINATION_FILE, timeout=30, isolation_level=None)
+    if _schema_ready:
+        return conn
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS shared_token (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            token_info TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rate_budget (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            backoff_until REAL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS worker_usage (
+            worker_id TEXT PRIMARY KEY,
+            requests INTEGER DEFAULT 0,
+            waited_ms REAL DEFAULT 0,
+            throttled INTEGER DEFAULT 0,
+            window_start REAL DEFAULT 0,
+            window_requests INTEGER DEFAULT 0,
+            last_seen REAL DEFAULT 0
+        )
+    ''')
+    _schema_ready = True
+    return conn
+
+
+@contextmanager
+def _exclusive():
+    """Write transaction used as a host-wide mutex"""
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        yield conn
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+# --- Shared access token -------------------------------------------------------
+
+class SharedTokenCache(CacheHandler):
+    """spotipy cache handler that keeps the token in the coordination database"""
+
+    def get_cached_token(self):
+        try:
+            conn = _connect()
+            row = conn.execute('SELECT token_info FROM shared_token WHERE id = 1').fetchone()
+            conn.close()
+            return json.loads(row[0]) if row and row[0] else None
+        except Exception as e:
+            logging.warning(f"Could not read shared token: {str(e)}")
+            return None
+
+    def save_token_to_cache(self, token_info):
+        try:
+            conn = _connect()
+            conn.execute('INSERT OR REPLACE INTO shared_token (id, token_info) VALUES (1, ?)', (json.dumps(token_info),))
+            conn.close()
+        except Exception as e:
+            logging.warning(f"Could not save shared token: {str(e)}")
+
+
+class SharedClientCredentials(SpotifyClientCredentials):
+    """Client-credentials manager where only one worker refreshes an expired token"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('cache_handler', SharedTokenCache())
+        super().__init__(*args, **kwargs)
+
+    def get_access_token(self, as_dict=False, check_cache=True):
+        token_info = self.cache_handler.get_cached_token() if check_cache else None
+        if token_info and not self.is_token_expired(token_info):
+            return token_info if as_dict else token_info['access_token']
+
+        with _exclusive() as conn:
+            # Another worker may have refreshed it while we waited for the lock
+            row = conn.execute('SELECT token_info FROM shared_token WHERE id = 1').fetchone()
+            token_info = json.loads(row[0]) if row and row[0] else None
+            if not token_info or self.is_token_expired(token_info):
+                token_info = self._add_custom_values_to_token_info(self._request_access_token())
+                conn.execute('INSERT OR REPLACE INTO shared_token (id, token_info) VALUES (1, ?)', (json.dumps(token_info),))
+                logging.info(f"Worker {_worker_id()} refreshed the shared Spotify token")
+        return token_info if as_dict else token_info['access_token']
+
+
+# --- Global request budget -----------------------------------------------------
+
+def acquire():
+    """
+    Block until this worker may send one request. Returns the seconds waited.
+
+    The bucket refills at RATE_PER_SECOND up to RATE_BURST. When several
+    workers are active and the bucket is running low, a worker that already
+    used its share of the current second steps aside for the others.
+    """
+    worker_id = _worker_id()
+    started = time.time()
+
+    while True:
+        with _exclusive() as conn:
+            now = time.time()
+            row = conn.execute('SELECT tokens, updated_at, backoff_until FROM rate_budget WHERE id = 1').fetchone()
+            tokens, updated_at, backoff_until = row if row else (RATE_BURST, now, 0.0)
+            tokens = min(RATE_BURST, tokens + (now - updated_at) * RATE_PER_SECOND)
+
+            conn.execute('INSERT OR IGNORE INTO worker_usage (worker_id, window_start) VALUES (?, ?)', (worker_id, now))
+            window_start, window_requests = conn.execute(
+                'SELECT window_start, window_requests FROM worker_usage WHERE worker_id = ?', (worker_id,)
+            ).fetchone()
+            if now - window_start >= 1.0:
+                window_start, window_requests = now, 0
+            active = conn.execute(
+                'SELECT COUNT(*) FROM worker_usage WHERE last_seen >= ? OR worker_id = ?',
+                (now - ACTIVE_WORKER_SECONDS, worker_id)
+            ).fetchone()[0]
+            fair_share = max(1, math.ceil(RATE_PER_SECOND / active))
+
+            waited = now - started
+            if backoff_until and backoff_until > now:
+                wait = backoff_until - now
+            elif active > 1 and window_requests >= fair_share and tokens < RATE_BURST / 2:
+                wait = 1.0 - (now - window_start)
+            elif tokens >= 1 or waited >= MAX_WAIT_SECONDS:
+                if tokens < 1:
+                    logging.warning(f"Worker {worker_id} waited {waited:.1f}s for request budget, proceeding")
+                conn.execute('INSERT OR REPLACE INTO rate_budget (id, tokens, updated_at, backoff_until) VALUES (1, ?, ?, ?)',
+                             (max(tokens - 1, 0.0), now, backoff_until))
+                conn.execute('''
+                    UPDATE worker_usage SET requests = requests + 1, waited_ms = waited_ms + ?,
+                        window_start = ?, window_requests = ?, last_seen = ?
+                    WHERE worker_id = ?
+                ''', (waited * 1000, window_start, window_requests + 1, now, worker_id))
+                return waited
+            else:
+                wait = (1 - tokens) / RATE_PER_SECOND
+
+            conn.execute('INSERT OR REPLACE INTO rate_budget (id, tokens, updated_at, backoff_until) VALUES (1, ?, ?, ?)',
+                         (tokens, now, backoff_until))
+            conn.execute('UPDATE worker_usage SET window_start = ?, window_requests = ?, last_seen = ? WHERE worker_id = ?',
+                         (window_start, window_requests, now, worker_id))
+        time.sleep(min(max(wait, 0.01), 1.0))
+
+
+def report_retry_after(seconds):
+    """Make every worker hold off until the Retry-After period is over"""
+    until = time.time() + seconds
+    with _exclusive() as conn:
+        conn.execute('INSERT OR IGNORE INTO rate_budget (id, tokens, updated_at, backoff_until) VALUES (1, 0, ?, 0)', (time.time(),))
+        conn.execute('UPDATE rate_budget SET tokens = 0, backoff_until = MAX(COALESCE(backoff_until, 0), ?) WHERE id = 1', (until,))
+        conn.execute('UPDATE worker_usage SET throttled = throttled + 1 WHERE worker_id = ?', (_worker_id(),))
+    logging.warning(f"Spotify rate limit hit, all workers backing off for {seconds:.0f}s")
+
+
+class BudgetedSpotify(spotipy.Spotify):
+    """Spotify client whose every API call draws from the shared budget"""
+
+    def __init__(self, *args, **kwargs):
+        # 429s must surface here so the backoff can be shared instead of
+        # being retried silently inside one worker
+        kwargs.setdefault('status_forcelist', (500, 502, 503, 504))
+        super().__init__(*args, **kwargs)
+
+    def _build_session(self):
+        # Same session as spotipy's, except urllib3 must not retry a 429 on
+        # its own: it does so for any response carrying Retry-After, even
+        # when 429 is not in status_forcelist
+        super()._build_session()
+        retry = urllib3.Retry(
+            total=self.retries,
+            connect=None,
+            read=False,
+            allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+            status=self.status_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=self.status_forcelist,
+            respect_retry_after_header=False)
+        adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def _internal_call(self, method, url, payload, params):
+        for attempt in range(MAX_429_RETRIES + 1):
+            acquire()
+            _request_calls.calls = getattr(_request_calls, 'calls', 0) + 1
+            try:
+                return super()._internal_call(method, url, payload, params)
+            except SpotifyException as e:
+                if e.http_status != 429 or attempt == MAX_429_RETRIES:
+                    raise
+                try:
+                    retry_after = float(e.headers.get('Retry-After', DEFAULT_RETRY_AFTER))
+                except (TypeError, ValueError):
+                    retry_after = DEFAULT_RETRY_AFTER
+                report_retry_after(retry_after)
+
+
+def get_usage():
+    """Global budget state and per-worker usage"""
+    conn = _connect()
+    conn.row_factory = sqlite3.Row
+    budget = conn.execute('SELECT tokens, updated_at, backoff_until FROM rate_budget WHERE id = 1').fetchone()
+    workers = [dict(row) for row in conn.execute('SELECT * FROM worker_usage ORDER BY worker_id')]
+    conn.close()
+
+    now = time.time()
+    total = sum(w['requests'] for w in workers) or 1
+    for worker in workers:
+        worker['share'] = round(worker['requests'] / total, 4)
+        worker['active'] = worker['last_seen'] >= now - ACTIVE_WORKER_SECONDS
+    return {
+        "rate_per_second": RATE_PER_SECOND,
+        "burst": RATE_BURST,
+        "tokens_available": round(min(RATE_BURST, budget['tokens'] + (now - budget['updated_at']) * RATE_PER_SECOND), 2) if budget else RATE_BURST,
+        "backoff_seconds": round(max(0.0, budget['backoff_until'] - now), 1) if budget and budget['backoff_until'] else 0.0,
+        "this_worker": _worker_id(),
+        "workers": workers
+    }
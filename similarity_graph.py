@@ -0,0 +1,274 @@
+"""
+Track-similarity graph: offline k-nearest-neighbour build over the track
+catalog and weighted shortest-path (A*) bridge discovery between two tracks.
+
+Run the build job with:  python similarity_graph.py --k 10
+"""
+import argparse
+import heapq
+import logging
+import math
+import sqlite3
+import time
+
+import database
+
+try:
+    import numpy as np
+except ImportError:  # numpy is in requirements.txt; without it only small catalogs can be built
+    np = None
+
+DEFAULT_K = 10
+DEFAULT_MAX_HOPS = 4
+MAX_HOPS_LIMIT = 20
+# Largest catalog the O(n^2) pure-Python kNN build is allowed to take on
+PYTHON_BUILD_LIMIT = 5000
+
+# Catalog columns that make up a track's position in feature space, with the
+# (low, high) range used to scale each one to 0..1 and its relative weight
+FEATURE_SCALES = [
+    ('tempo', 50.0, 200.0, 1.5),
+    ('energy', 0.0, 1.0, 1.0),
+    ('danceability', 0.0, 1.0, 1.0),
+    ('valence', 0.0, 1.0, 1.0),
+    ('acousticness', 0.0, 1.0, 0.5),
+    ('loudness', -60.0, 0.0, 0.5),
+]
+
+_DEFAULTS = {'tempo': 120.0, 'energy': 0.5, 'danceability': 0.5, 'valence': 0.5,
+             'acousticness': 0.5, 'loudness': -10.0}
+
+
+def feature_vector(row):
+    """Scaled, weighted feature-space coordinates for a catalog row or features dict"""
+    vector = []
+    for name, low, high, weight in FEATURE_SCALES:
+        value = row.get(name)
+        if value is None:
+            value = _DEFAULTS[name]
+        scaled = (value - low) / (high - low)
+        vector.append(min(max(scaled, 0.0), 1.0) * weight)
+    return tuple(vector)
+
+
+def distance(a, b):
+    """Euclidean distance between two feature vectors (the stored edge weight)"""
+    return math.sqrt(sum((x - y) ** 2 for x, y in zip(a, b)))
+
+
+def _knn_numpy(vectors, k, chunk_size=1024):
+    matrix = np.asarray(vectors, dtype=np.float32)
+    squared = (matrix ** 2).sum(axis=1)
+    n = len(matrix)
+    k = min(k, n - 1)
+    for start in range(0, n, chunk_size):
+        block = matrix[start:start + chunk_size]
+        dists = squared[start:start + chunk_size, None] + squared[None, :] - 2.0 * block @ matrix.T
+        np.maximum(dists, 0.0, out=dists)
+        for offset in range(len(block)):
+            dists[offset, start + offset] = np.inf  # no self-loops
+        nearest = np.argpartition(dists, k, axis=1)[:, :k]
+        for offset, row in enumerate(nearest):
+            i = start + offset
+            for j in row:
+                yield i, int(j), float(math.sqrt(dists[offset, j]))
+
+
+def _knn_python(vectors, k):
+    for i, vector in enumerate(vectors):
+        candidates = ((distance(vector, other), j) for j, other in enumerate(vectors) if j != i)
+        for dist, j in heapq.nsmallest(k, candidates):
+            yield i, j, dist
+
+
+def build_graph(k=DEFAULT_K):
+    """
+    Rebuild the adjacency table from the catalog. Each track is linked to its
+    k nearest neighbours in both directions, so a bridge can be walked either
+    way. The old graph is replaced in a single transaction.
+    """
+    started = time.perf_counter()
+    rows = database.get_catalog_features()
+    if len(rows) < 2:
+        logging.warning("Not enough catalogued tracks to build a similarity graph")
+        return {"tracks": len(rows), "edges": 0, "elapsed_ms": 0.0}
+
+    if np is None and len(rows) > PYTHON_BUILD_LIMIT:
+        message = (f"numpy is not installed and the catalog has {len(rows)} tracks; the pure-Python build "
+                   f"only handles up to {PYTHON_BUILD_LIMIT}. Install numpy (see requirements.txt)")
+        logging.error(message)
+        return {"tracks": len(rows), "edges": 0, "elapsed_ms": 0.0, "error": message}
+
+    ids = [row['track_id'] for row in rows]
+    vectors = [feature_vector(row) for row in rows]
+    pairs = _knn_numpy(vectors, k) if np is not None else _knn_python(vectors, k)
+
+    edges = {}
+    for i, j, weight in pairs:
+        for src, dst in ((ids[i], ids[j]), (ids[j], ids[i])):
+            if (src, dst) not in edges or weight < edges[(src, dst)]:
+                edges[(src, dst)] = weight
+
+    conn = sqlite3.connect(database.DATABASE_FILE)
+    try:
+        with conn:
+            conn.execute('DELETE FROM track_edges')
+            conn.executemany(
+                'INSERT INTO track_edges (src, dst, weight) VALUES (?, ?, ?)',
+                ((src, dst, weight) for (src, dst), weight in edges.items())
+            )
+    finally:
+        conn.close()
+
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+    logging.info(f"Similarity graph built: {len(ids)} tracks, {len(edges)} edges in {elapsed_ms}ms")
+    return {"tracks": len(ids), "edges": len(edges), "elapsed_ms": elapsed_ms}
+
+
+_NEIGHBOURS_SQL = '''
+    SELECT e.dst, e.weight, c.tempo, c.energy, c.danceability, c.valence, c.acousticness, c.loudness
+    FROM track_edges e JOIN track_catalog c ON c.track_id = e.dst
+    WHERE e.src = ?
+'''
+
+_NODE_SQL = '''
+    SELECT track_id, track_name, artist_name, tempo, energy, danceability, valence, acousticness, loudness
+    FROM track_catalog WHERE track_id = ?
+'''
+
+
+def _node(conn, track_id):
+    row = conn.execute(_NODE_SQL, (track_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def _heuristic(vector, target, remaining):
+    """
+    Lower bound on the remaining cost. A path of at most `remaining` edges
+    covering straight-line distance d costs at least d^2 / remaining in
+    squared steps (equal steps are cheapest), so A* stays admissible.
+    """
+    if remaining <= 0:
+        return 0.0 if vector == target else math.inf
+    return distance(vector, target) ** 2 / remaining
+
+
+def _on_path(parents, state, track_id):
+    while state is not None:
+        if state[0] == track_id:
+            return True
+        state = parents[state]
+    return False
+
+
+def find_bridge(start_id, end_id, max_hops=DEFAULT_MAX_HOPS, hops=None):
+    """
+    A* search over the stored graph for the smoothest path between two
+    tracks. Each step costs its squared feature-space distance, so several
+    small steps beat one large jump. With `hops` the path has exactly that
+    many edges; otherwise it has at most `max_hops`. A track appears at most
+    once on a path. Neighbours are read from the clustered adjacency table on
+    demand, so only the explored part of the graph is touched.
+    """
+    started = time.perf_counter()
+    exact = hops is not None
+    max_hops = max(1, min(int(hops if exact else max_hops), MAX_HOPS_LIMIT))
+
+    conn = sqlite3.connect(database.DATABASE_FILE)
+    conn.row_factory = sqlite3.Row
+    try:
+        start = _node(conn, start_id)
+        end = _node(conn, end_id)
+        if not start or not end:
+            return {"error": "Both tracks must be in the catalog"}, 404
+
+        target = feature_vector(end)
+        vectors = {start_id: feature_vector(start)}
+        open_heap = [(_heuristic(vectors[start_id], target, max_hops), 0.0, 0, start_id)]
+        parents = {(start_id, 0): None}
+        best_cost = {(start_id, 0): 0.0}
+        settled = set()
+        expanded = 0
+        hop_limited = False
+        found = None
+
+        while open_heap:
+            _, cost, depth, node = heapq.heappop(open_heap)
+            state = (node, depth)
+            if state in settled or cost > best_cost[state]:
+                continue  # stale heap entry
+            settled.add(state)
+
+            if node == end_id and (not exact or depth == max_hops):
+                found = (node, depth, cost)
+                break
+            if depth == max_hops or node == end_id:
+                continue
+
+            expanded += 1
+            remaining = max_hops - depth - 1
+            for row in conn.execute(_NEIGHBOURS_SQL, (node,)):
+                neighbour = row['dst']
+                if _on_path(parents, state, neighbour):
+                    continue
+                if neighbour not in vectors:
+                    vectors[neighbour] = feature_vector(dict(row))
+                next_state = (neighbour, depth + 1)
+                new_cost = cost + row['weight'] ** 2
+                if new_cost >= best_cost.get(next_state, math.inf):
+                    continue
+                best_cost[next_state] = new_cost
+                parents[next_state] = state
+                estimate = 0.0 if neighbour == end_id else _heuristic(vectors[neighbour], target, remaining)
+                if estimate == math.inf:
+                    hop_limited = True  # the hop budget ran out before the target
+                    continue
+                heapq.heappush(open_heap, (new_cost + estimate, new_cost, depth + 1, neighbour))
+
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+        if found is None:
+            if exact:
+                error = f"No bridge of exactly {max_hops} hops"
+            elif hop_limited:
+                error = f"No bridge within {max_hops} hops; the hop limit stopped the search (maximum {MAX_HOPS_LIMIT})"
+            else:
+                error = "No bridge: the tracks are not connected in the similarity graph"
+            return {"error": error, "hop_limited": hop_limited, "nodes_expanded": expanded, "elapsed_ms": elapsed_ms}, 404
+
+        path = []
+        state = (found[0], found[1])
+        while state is not None:
+            path.append(state[0])
+            state = parents[state]
+        path.reverse()
+
+        bridge = []
+        for track_id in path[1:-1]:
+            node = _node(conn, track_id) or {'track_id': track_id}
+            bridge.append({
+                "id": track_id,
+                "name": node.get('track_name'),
+                "artist": node.get('artist_name'),
+                "tempo": node.get('tempo'),
+                "energy": node.get('energy')
+            })
+
+        return {
+            "bridge": bridge,
+            "path": path,
+            "hops": len(path) - 1,
+            "path_cost": round(found[2], 6),
+            "nodes_expanded": expanded,
+            "elapsed_ms": elapsed_ms
+        }
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build the track-similarity graph from the catalog")
+    parser.add_argument('--k', type=int, default=DEFAULT_K, help="neighbours per track")
+    args = parser.parse_args()
+    database.ensure_schema()
+    print(build_graph(args.k))
@@ -1,26 +1,58 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import os
 import logging
-from flask import Flask, render_template, jsonify, request, session
+import threading
+import json
+from functools import wraps
+from flask import Blueprint, Flask, Response, current_app, make_response, render_template, jsonify, request, session, stream_with_context
 from spotipy.oauth2 import SpotifyOAuth, SpotifyClientCredentials
 import spotipy
 import spotify_client
 import database
 import transition_algorithms
+import http_cache
+import warmup
+import similarity_graph
+import preview_index
+import circuit_breaker
+import jobs
+import profiling
+import shared_budget
+import playlist_sessions
+import artist_pool
+import compatibility
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-here'
+bp = Blueprint('main', __name__)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 def get_spotify_client():
-    return spotify_client.create_spotify_client()
+    return spotify_client.get_shared_client()
+
+def report_upstream_calls(view):
+    """
+    Report this request's upstream calls in X-Upstream-Calls headers. Applied
+    outside cached_route, so a response served from the cache reports the
+    (zero) calls of the request that received it, not the one that built it.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        shared_budget.reset_request_calls()
+        response = make_response(view(*args, **kwargs))
+        calls = shared_budget.request_calls()
+        response.headers['X-Upstream-Calls'] = str(calls['upstream_calls'])
+        response.headers['X-Upstream-Calls-Saved'] = str(calls['upstream_calls_saved'])
+        return response
+    return wrapper
 
-@app.route('/')
+@bp.route('/')
 def home():
     return render_template('search.html')
 
-@app.route('/api/search_tracks')
+@bp.route('/api/search_tracks')
 def search_tracks():
     query = request.args.get('query', '')
     if not query:
@@ -53,7 +85,9 @@ def search_tracks():
         logging.error(f"Search error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/popular_tracks")
+@bp.route("/api/popular_tracks")
+@report_upstream_calls
+@http_cache.cached_route('snapshot')
 def get_popular_tracks():
     """Get popular tracks with aggressive strategies to find ones with preview URLs"""
     sp = get_spotify_client()
@@ -78,11 +112,14 @@ def get_popular_tracks():
             "about damn time lizzo", "running up that hill kate bush", "sunroof nicky youre"
         ]
         
-        for track_search in known_hits[:12]:  # Search first 12
+        # Try high-yield queries first; ones that never return previews go last
+        # Searches run concurrently; the fan-out stops once the leading results hold 15 tracks
+        hit_queries = preview_index.rank_sources("query", known_hits)[:12]  # Search first 12
+        for track_search, items in spotify_client.multi_search(sp, hit_queries, limit=3, target_count=15, market="US"):
             try:
-                search_results = sp.search(q=track_search, type="track", limit=3, market="US")
-                if search_results and search_results.get("tracks", {}).get("items"):
-                    for track in search_results["tracks"]["items"]:
+                if items:
+                    preview_index.record_tracks(items, "Known Hit Songs", "query", track_search)
+                    for track in items:
                         if len(tracks) >= 20:  # Limit
                             break
                             
@@ -127,12 +164,16 @@ def get_popular_tracks():
                 '"greatest hits" year:2020-2024'
             ]
             
-            for query in special_queries[:3]:
+            special_results = spotify_client.multi_search(
+                sp, preview_index.rank_sources("query", special_queries)[:3], limit=12,
+                target_previews=8 - tracks_with_preview, exclude={t["id"] for t in tracks}, market="US"
+            )
+            for query, items in special_results:
                 try:
-                    search_results = sp.search(q=query, type="track", limit=12, market="US")
-                    if search_results and search_results.get("tracks", {}).get("items"):
+                    if items:
+                        preview_index.record_tracks(items, "Special Versions", "query", query)
                         found_in_query = 0
-                        for track in search_results["tracks"]["items"]:
+                        for track in items:
                             if len(tracks) >= 20:
                                 break
                                 
@@ -169,10 +210,15 @@ def get_popular_tracks():
             try:
                 playlists = sp.featured_playlists(limit=5, country="US")
                 if playlists and playlists.get("playlists", {}).get("items"):
-                    for playlist in playlists["playlists"]["items"][:3]:
+                    candidates = [p for p in playlists["playlists"]["items"] if not preview_index.is_known_empty("playlist", p["id"])]
+                    for playlist in candidates[:3]:
                         try:
                             playlist_tracks = sp.playlist_tracks(playlist["id"], limit=15)
                             if playlist_tracks and playlist_tracks.get("items"):
+                                preview_index.record_tracks(
+                                    [item.get("track") for item in playlist_tracks["items"]],
+                                    "Featured Playlists", "playlist", playlist["id"]
+                                )
                                 found_in_playlist = 0
                                 for item in playlist_tracks["items"]:
                                     track = item.get("track")
@@ -207,57 +253,33 @@ def get_popular_tracks():
             except Exception as e:
                 print(f"Featured playlists strategy failed: {e}")
         
-        # Strategy 4: Popular artist albums
+        # Strategy 4: Popular artists' top tracks
         if tracks_with_preview < 3:
-            print("Searching popular artist albums...")
+            print("Searching popular artist top tracks...")
             popular_artists = ["drake", "taylor swift", "ariana grande", "post malone", "billie eilish"]
             
-            for artist_name in popular_artists[:3]:
+            for artist_name in preview_index.rank_sources("artist", popular_artists)[:3]:
                 try:
-                    artist_results = sp.search(q=artist_name, type="artist", limit=1)
-                    if artist_results["artists"]["items"]:
-                        artist_id = artist_results["artists"]["items"][0]["id"]
-                        albums = sp.artist_albums(artist_id, album_type="album,single", limit=3)
+                    # Cached per-artist pool instead of the albums -> tracks -> track walk
+                    pool = artist_pool.get_artist_pool_by_query(sp, artist_name)
+                    preview_index.record_tracks(pool, "Popular Artists", "artist", artist_name)
+                    
+                    for track_info in pool:
+                        if len(tracks) >= 20:
+                            break
                         
-                        for album in albums["items"]:
-                            try:
-                                album_tracks = sp.album_tracks(album["id"], limit=8)
-                                for track in album_tracks["items"]:
-                                    if len(tracks) >= 20:
-                                        break
-                                    
-                                    # Get full track details
-                                    full_track = sp.track(track["id"])
-                                    
-                                    # Skip duplicates
-                                    if any(t["id"] == full_track["id"] for t in tracks):
-                                        continue
-                                        
-                                    track_info = {
-                                        "id": full_track["id"],
-                                        "name": full_track["name"],
-                                        "artist": full_track["artists"][0]["name"] if full_track.get("artists") else artist_name,
-                                        "album": full_track["album"]["name"] if full_track.get("album") else "",
-                                        "preview_url": full_track.get("preview_url"),
-                                        "popularity": full_track.get("popularity", 0),
-                                        "duration_ms": full_track.get("duration_ms", 0),
-                                        "external_urls": full_track.get("external_urls", {})
-                                    }
-                                    
-                                    tracks.append(track_info)
-                                    if full_track.get("preview_url"):
-                                        tracks_with_preview += 1
-                                        print(f"✓ Preview from {artist_name} album: {full_track['name']}")
-                                
-                                if len(tracks) >= 18:
-                                    break
-                            except Exception as e:
-                                print(f"Album tracks failed: {e}")
-                                continue
+                        # Skip duplicates
+                        if any(t["id"] == track_info["id"] for t in tracks):
+                            continue
+                        
+                        tracks.append(dict(track_info, artist=track_info["artist"] or artist_name))
+                        if track_info.get("preview_url"):
+                            tracks_with_preview += 1
+                            print(f"✓ Preview from {artist_name} top tracks: {track_info['name']}")
+                    
+                    if tracks_with_preview > 0 and "Popular Artists" not in strategies_used:
+                        strategies_used.append("Popular Artists")
                         
-                        if tracks_with_preview > 0 and "Popular Artists" not in strategies_used:
-                            strategies_used.append("Popular Artists")
-                            
                 except Exception as e:
                     print(f"Artist {artist_name} search failed: {e}")
                     continue
@@ -279,19 +301,22 @@ def get_popular_tracks():
         
         print(f"Final result: {len(final_tracks)} tracks, {final_preview_count} with previews")
         
-        return jsonify({
+        response = jsonify({
             "tracks": final_tracks,
             "total_found": len(final_tracks),
             "preview_count": final_preview_count,
             "strategies_used": strategies_used if strategies_used else ["Basic Search"]
         })
+        # An empty snapshot means every strategy failed: serve it, but don't keep it
+        return response if final_tracks else http_cache.mark_fallback(response)
         
     except Exception as e:
         print(f"Error in get_popular_tracks: {e}")
         logging.error(f"Popular tracks error: {str(e)}")
         return jsonify({"error": f"Failed to fetch popular tracks: {str(e)}"}), 500
 
-@app.route('/api/track_features/<track_id>')
+@bp.route('/api/track_features/<track_id>')
+@http_cache.cached_route('features')
 def get_track_features(track_id):
     try:
         sp = get_spotify_client()
@@ -299,13 +324,16 @@ def get_track_features(track_id):
             return jsonify({"error": "authentication_failed"}), 401
         
         features = spotify_client.get_track_features(sp, track_id)
+        if features is spotify_client.DEFAULT_FEATURES:
+            # Placeholder values while Spotify is failing: serve, never cache
+            return http_cache.mark_fallback(jsonify(features))
         return jsonify(features)
     
     except Exception as e:
         logging.error(f"Track features error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/basic_recommendations', methods=['POST'])
+@bp.route('/api/basic_recommendations', methods=['POST'])
 def basic_recommendations():
     try:
         data = request.json
@@ -327,7 +355,7 @@ def basic_recommendations():
         logging.error(f"Basic recommendations error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/smart_recommendations', methods=['POST'])
+@bp.route('/api/smart_recommendations', methods=['POST'])
 def smart_recommendations():
     try:
         data = request.json
@@ -341,7 +369,10 @@ def smart_recommendations():
             return jsonify({"error": "authentication_failed"}), 401
         
         # Get smart recommendations using our algorithm with correct parameters
+        shared_budget.reset_request_calls()
         result = transition_algorithms.smart_transition_algorithm(sp, track_ids)
+        if isinstance(result, dict):
+            result["upstream"] = shared_budget.request_calls()
         
         return jsonify(result)
     
@@ -349,7 +380,61 @@ def smart_recommendations():
         logging.error(f"Smart recommendations error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/playlist_preview', methods=['POST'])
+@bp.route('/api/bridge', methods=['POST'])
+def bridge():
+    """Multi-hop bridge between two tracks from the stored similarity graph (no Spotify calls)"""
+    try:
+        data = request.json
+        track_ids = data.get('track_ids', [])
+        
+        if not track_ids or len(track_ids) != 2:
+            return jsonify({"error": "Please provide exactly 2 track IDs"}), 400
+        
+        try:
+            max_hops = int(data.get('max_hops', similarity_graph.DEFAULT_MAX_HOPS))
+            hops = int(data['hops']) if data.get('hops') is not None else None
+        except (TypeError, ValueError):
+            return jsonify({"error": "max_hops and hops must be integers"}), 400
+        limit = similarity_graph.MAX_HOPS_LIMIT
+        if not 1 <= max_hops <= limit or (hops is not None and not 1 <= hops <= limit):
+            return jsonify({"error": f"max_hops and hops must be between 1 and {limit}"}), 400
+        
+        result = similarity_graph.find_bridge(track_ids[0], track_ids[1], max_hops=max_hops, hops=hops)
+        if isinstance(result, tuple):
+            body, status = result
+            return jsonify(body), status
+        
+        return jsonify(result)
+    
+    except Exception as e:
+        logging.error(f"Bridge error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@bp.route('/api/compatibility_matrix', methods=['POST'])
+def compatibility_matrix():
+    """Key/tempo/energy transition scores for every ordered pair of tracks (no Spotify calls)"""
+    try:
+        data = request.json
+        track_ids = data.get('track_ids', [])
+        top = int(data.get('top', 5))
+        
+        if len(track_ids) < 2:
+            return jsonify({"error": "Please provide at least 2 track IDs"}), 400
+        
+        result = compatibility.score_matrix(track_ids)
+        result["best_next"] = compatibility.best_next(result, top=top)
+        if not data.get('include_matrix', True):
+            del result["matrix"]
+        
+        return jsonify(result)
+    
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Compatibility matrix error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@bp.route('/api/playlist_preview', methods=['POST'])
 def playlist_preview():
     """Create a playlist preview for transition simulation"""
     try:
@@ -400,7 +485,7 @@ def playlist_preview():
         logging.error(f"Playlist preview error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/save_settings', methods=['POST'])
+@bp.route('/api/save_settings', methods=['POST'])
 def save_settings():
     try:
         data = request.json
@@ -412,6 +497,8 @@ def save_settings():
         
         # Save settings to database
         database.save_track_settings(track_id, settings)
+        http_cache.settings_changed()
+        http_cache.invalidate(f'/api/get_settings/{track_id}')
         
         return jsonify({"success": True, "message": "Settings saved successfully"})
     
@@ -419,7 +506,8 @@ def save_settings():
         logging.error(f"Save settings error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/get_settings/<track_id>')
+@bp.route('/api/get_settings/<track_id>')
+@http_cache.cached_route('revalidate', generation=http_cache.settings_generation)
 def get_settings(track_id):
     try:
         settings = database.get_track_settings(track_id)
@@ -429,6 +517,199 @@ def get_settings(track_id):
         logging.error(f"Get settings error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@bp.route('/api/preview_index')
+def preview_index_stats():
+    """Preview-availability index hit rates and preview yield per strategy"""
+    return jsonify(preview_index.get_stats())
+
+@bp.route('/api/playlist_sessions', methods=['POST'])
+def create_playlist_session():
+    """Start a playlist session; later edits only recompute the pairs they change"""
+    try:
+        data = request.json
+        track_ids = data.get('track_ids', [])
+        
+        if len(track_ids) < 2:
+            return jsonify({"error": "Please provide at least 2 track IDs"}), 400
+        
+        result = playlist_sessions.create_session(track_ids, data.get('algorithm', 'smart'))
+        return jsonify(result), 201
+    
+    except Exception as e:
+        logging.error(f"Create playlist session error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@bp.route('/api/playlist_sessions/<session_id>')
+def get_playlist_session(session_id):
+    session_data = playlist_sessions.get_session(session_id)
+    if not session_data:
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify(session_data)
+
+@bp.route('/api/playlist_sessions/<session_id>/edits', methods=['POST'])
+def edit_playlist_session(session_id):
+    """Apply insert/remove/move operations and return the updated transitions"""
+    try:
+        data = request.json
+        ops = data.get('ops', [])
+        
+        if not ops:
+            return jsonify({"error": "Edit operations are required"}), 400
+        
+        result = playlist_sessions.edit_session(session_id, ops, data.get('base_version'))
+        if result is None:
+            return jsonify({"error": "Session not found"}), 404
+        
+        return jsonify(result)
+    
+    except playlist_sessions.SessionConflict as e:
+        return jsonify({"error": str(e)}), 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Edit playlist session error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@bp.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """Queue a transition playlist build; poll /api/jobs/<id> or stream /api/jobs/<id>/events"""
+    try:
+        data = request.json
+        track_ids = data.get('track_ids', [])
+        
+        if len(track_ids) < 2:
+            return jsonify({"error": "Please provide at least 2 track IDs"}), 400
+        
+        params = {
+            "track_ids": track_ids,
+            "algorithm": data.get('algorithm', 'smart'),
+            "bridges_per_pair": int(data.get('bridges_per_pair', 1)),
+            "concurrency": int(data.get('concurrency', jobs.DEFAULT_CONCURRENCY))
+        }
+        job_id = jobs.submit_job(data.get('kind', 'transition_playlist'), params)
+        
+        return jsonify({"job_id": job_id, "status": jobs.QUEUED, "total_steps": len(track_ids) - 1}), 202
+    
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Submit job error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@bp.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    job = jobs.get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@bp.route('/api/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-sent events with job progress until the job finishes"""
+    if not jobs.get_job(job_id, include_steps=False):
+        return jsonify({"error": "Job not found"}), 404
+    
+    def generate():
+        last = None
+        while True:
+            job = jobs.get_job(job_id, include_steps=False)
+            update = (job['status'], job['progress'])
+            if update != last:
+                last = update
+                payload = {"status": job['status'], "progress": job['progress'], "total": job['total']}
+                yield f"data: {json.dumps(payload)}\n\n"
+            if job['status'] in jobs.TERMINAL:
+                break
+            time.sleep(0.5)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+@bp.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if not jobs.cancel_job(job_id):
+        return jsonify({"error": "Job not found or already finished"}), 404
+    return jsonify({"success": True, "message": "Cancellation requested"})
+
+@bp.route('/api/rate_budget')
+def rate_budget():
+    """Shared Spotify request budget and per-worker usage on this host"""
+    try:
+        return jsonify(shared_budget.get_usage())
+    except Exception as e:
+        logging.error(f"Rate budget error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@bp.route('/api/circuit_breakers')
+def circuit_breakers():
+    """State of the per-endpoint circuit breakers in this process"""
+    return jsonify(circuit_breaker.get_all_status())
+
+@bp.route('/api/ready')
+def ready():
+    """Readiness probe: startup phase timings and cache warm-up progress"""
+    startup = current_app.extensions['startup']
+    warm = warmup.get_status()
+    # A background warm-up still running means cold caches: keep traffic away until it ends
+    is_ready = startup['mode'] not in ('background', 'blocking') or warm['status'] in ('done', 'failed')
+    return jsonify({
+        "ready": is_ready,
+        "startup": {
+            "phases_ms": startup['phases_ms'],
+            "total_ms": startup['total_ms'],
+            "mode": startup['mode']
+        },
+        "warmup": warm
+    }), 200 if is_ready else 503
+
+def create_app(config=None):
+    """
+    Application factory. Times each startup phase, runs schema setup once per
+    process and optionally warms caches.
+
+    WARMUP (config or env): 'off' (default), 'background' to warm on a thread
+    while serving, or 'blocking' to finish warming before returning the app.
+    """
+    started = time.perf_counter()
+    phases = {'imports': round(IMPORT_SECONDS * 1000, 2)}
+
+    def mark(name, since):
+        now = time.perf_counter()
+        phases[name] = round((now - since) * 1000, 2)
+        return now
+
+    t = time.perf_counter()
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-here')
+    app.config['WARMUP'] = os.getenv('WARMUP', 'off')
+    if config:
+        app.config.update(config)
+    t = mark('config', t)
+
+    database.ensure_schema()
+    t = mark('database', t)
+
+    jobs.start_maintenance()
+    t = mark('jobs', t)
+
+    app.register_blueprint(bp)
+    http_cache.init_app(app)
+    profiling.init_app(app)
+    t = mark('routes', t)
+
+    mode = app.config['WARMUP']
+    app.extensions['startup'] = {'phases_ms': phases, 'total_ms': None, 'mode': mode}
+
+    if mode == 'blocking':
+        warmup.warm_caches(app)
+        t = mark('warmup', t)
+    elif mode == 'background':
+        threading.Thread(target=warmup.warm_caches, args=(app,), name='cache-warmup', daemon=True).start()
+
+    app.extensions['startup']['total_ms'] = round((time.perf_counter() - started) * 1000 + phases['imports'], 2)
+    logging.info(f"App created in {app.extensions['startup']['total_ms']}ms: {phases}")
+    return app
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
 if __name__ == '__main__':
-    database.init_database()
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    create_app().run(host='0.0.0.0', port=5001, debug=True)
@@ -1,11 +1,24 @@
 import os
 from dotenv import load_dotenv
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import database
+import shared_budget
+import profiling
+from circuit_breaker import get_breaker, CircuitOpenError
+from shared_budget import BudgetedSpotify, SharedClientCredentials
 
 load_dotenv()
 
+_shared_client = None
+_shared_lock = threading.Lock()
+
+# Threads shared by every multi_search call; each call also caps its own concurrency
+MULTI_SEARCH_WORKERS = int(os.getenv('MULTI_SEARCH_WORKERS', 8))
+MULTI_SEARCH_CONCURRENCY = 4
+_search_executor = ThreadPoolExecutor(max_workers=MULTI_SEARCH_WORKERS, thread_name_prefix='search')
+
 def create_spotify_client():
     
     try:
@@ -16,13 +29,14 @@ def create_spotify_client():
             logging.error("Missing Spotify credentials in environment variables")
             return None
             
-        # Client Credentials Flow (for app-level access)
-        client_credentials_manager = SpotifyClientCredentials(
+        # Client Credentials Flow (for app-level access), with the token and
+        # request budget shared by every worker process on this host
+        client_credentials_manager = SharedClientCredentials(
             client_id=client_id,
             client_secret=client_secret
         )
         
-        sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+        sp = BudgetedSpotify(client_credentials_manager=client_credentials_manager)
         
         # Test the connection
         sp.search(q="test", type="track", limit=1)
@@ -33,53 +47,175 @@ def create_spotify_client():
         logging.error(f"Failed to create Spotify client: {str(e)}")
         return None
 
+def get_shared_client():
+    """
+    Process-wide Spotify client. Client-credentials tokens refresh themselves,
+    so one authenticated client can serve every request instead of
+    re-authenticating (and re-testing the connection) per request.
+    """
+    global _shared_client
+    if _shared_client is not None:
+        return _shared_client
+    with _shared_lock:
+        if _shared_client is None:
+            _shared_client = create_spotify_client()
+        return _shared_client
+
+# Returned (as this exact object) when the API fails, so callers can tell
+# placeholder values from real features; treat it as read-only
+DEFAULT_FEATURES = {
+    'tempo': 120.0,
+    'energy': 0.5,
+    'danceability': 0.5,
+    'valence': 0.5,
+    'acousticness': 0.5,
+    'instrumentalness': 0.0,
+    'liveness': 0.1,
+    'speechiness': 0.1,
+    'loudness': -10.0
+}
+
 def get_track_features(sp, track_id):
     """
     Get audio features for a track with error handling
     """
     try:
-        features = sp.audio_features([track_id])
+        features = get_breaker('audio_features').call(sp.audio_features, [track_id])
         if features and features[0]:
+            # Write-through so offline jobs can work from the catalog
+            database.save_catalog_track(track_id, features[0])
             return features[0]
         return None
     except Exception as e:
-        logging.warning(f"Could not get features for track {track_id}: {str(e)}")
-        # Return default values if API fails
-        return {
-            'tempo': 120.0,
-            'energy': 0.5,
-            'danceability': 0.5,
-            'valence': 0.5,
-            'acousticness': 0.5,
-            'instrumentalness': 0.0,
-            'liveness': 0.1,
-            'speechiness': 0.1,
-            'loudness': -10.0
-        }
-
-def search_tracks(sp, query, limit=20):
+        if not isinstance(e, CircuitOpenError):
+            logging.warning(f"Could not get features for track {track_id}: {str(e)}")
+        # Return default values if API fails or its circuit is open
+        return DEFAULT_FEATURES
+
+def get_tracks_features(sp, track_ids):
+    """
+    Audio features for many tracks in one call per 100 ids, written through
+    to the catalog. Tracks the API has no features for, or every track when
+    it fails or its circuit is open, are left out; no placeholders.
+    """
+    found = {}
+    track_ids = list(dict.fromkeys(track_ids))
+    for start in range(0, len(track_ids), 100):
+        chunk = track_ids[start:start + 100]
+        try:
+            features = get_breaker('audio_features').call(sp.audio_features, chunk)
+        except Exception as e:
+            if not isinstance(e, CircuitOpenError):
+                logging.warning(f"Could not get features for {len(chunk)} tracks: {str(e)}")
+            break
+        for track_id, row in zip(chunk, features or []):
+            if row:
+                database.save_catalog_track(track_id, row)
+                found[track_id] = row
+    return found
+
+def search_tracks(sp, query, limit=20, **kwargs):
     """
     Search for tracks with error handling
     """
     try:
-        results = sp.search(q=query, type='track', limit=limit)
+        results = sp.search(q=query, type='track', limit=limit, **kwargs)
         return results.get('tracks', {}).get('items', [])
     except Exception as e:
         logging.error(f"Search failed for query '{query}': {str(e)}")
         return []
 
+def _counted_search(sp, query, limit, kwargs, profile):
+    # Runs on a pool thread: sampled into the request's profile, if any
+    with profiling.attached(profile):
+        shared_budget.reset_request_calls()
+        items = search_tracks(sp, query, limit=limit, **kwargs)
+        return items, shared_budget.request_calls()['upstream_calls']
+
+def multi_search(sp, queries, limit=20, target_count=None, target_previews=None,
+                 exclude=None, max_concurrency=MULTI_SEARCH_CONCURRENCY, **kwargs):
+    """
+    Run several track searches concurrently and return [(query, items), ...]
+    in query-priority order.
+
+    Queries are started in priority order, at most `max_concurrency` at once.
+    As soon as the leading queries that have finished together hold
+    `target_count` new tracks or `target_previews` new tracks with previews
+    (ignoring ids in `exclude`), the remaining queries are dropped and only
+    that leading run is returned. Every call still goes through the shared
+    rate budget of the Spotify client.
+    """
+    queries = list(queries)
+    profile = profiling.context()
+    results = [None] * len(queries)
+    seen = set(exclude or ())
+    in_flight = {}
+    next_query = 0
+    prefix = 0
+    found = 0
+    previews = 0
+
+    reached = False
+    while prefix < len(queries) and not reached:
+        while next_query < len(queries) and len(in_flight) < max_concurrency:
+            future = _search_executor.submit(_counted_search, sp, queries[next_query], limit, kwargs, profile)
+            in_flight[future] = next_query
+            next_query += 1
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            items, calls = future.result()
+            shared_budget.add_request_calls(calls)
+            results[in_flight.pop(future)] = items
+
+        # Merge strictly in priority order: a later query only counts once
+        # every query before it has finished
+        while prefix < len(queries) and results[prefix] is not None:
+            for track in results[prefix]:
+                if track and track.get('id') and track['id'] not in seen:
+                    seen.add(track['id'])
+                    found += 1
+                    if track.get('preview_url'):
+                        previews += 1
+            prefix += 1
+            reached = (target_count is not None and found >= target_count) or \
+                (target_previews is not None and previews >= target_previews)
+            if reached:
+                break
+
+    # Queries still running finish in the background; their calls are
+    # counted by the shared budget but not credited to this request
+    for future in in_flight:
+        future.cancel()
+    return [(queries[i], results[i]) for i in range(prefix)]
+
 def get_recommendations(sp, seed_tracks=None, seed_artists=None, seed_genres=None, limit=20, **kwargs):
     """
     Get recommendations with error handling
     """
     try:
-        return sp.recommendations(
+        return get_breaker('recommendations').call(
+            sp.recommendations,
             seed_tracks=seed_tracks,
             seed_artists=seed_artists, 
             seed_genres=seed_genres,
             limit=limit,
             **kwargs
         )
+    except CircuitOpenError:
+        return {'tracks': []}
     except Exception as e:
         logging.error(f"Recommendations failed: {str(e)}")
         return {'tracks': []}
+
+def get_related_artists(sp, artist_id):
+    """
+    Get related artists with error handling (empty list on failure or open circuit)
+    """
+    try:
+        return get_breaker('artist_related_artists').call(sp.artist_related_artists, artist_id).get('artists', [])
+    except CircuitOpenError:
+        return []
+    except Exception as e:
+        logging.warning(f"Related artists failed for {artist_id}: {str(e)}")
+        return []
@@ -0,0 +1,67 @@
+"""
+BudgetedSpotify must see every 429 itself, so the backoff is shared through
+the coordination database instead of being retried inside one worker.
+
+Run with:  python -m pytest -q test_shared_budget.py
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from spotipy.exceptions import SpotifyException
+
+import shared_budget
+
+
+class _RateLimited(BaseHTTPRequestHandler):
+    hits = 0
+
+    def do_GET(self):
+        type(self).hits += 1
+        body = b'{"error": {"status": 429, "message": "API rate limit exceeded"}}'
+        self.send_response(429)
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def rate_limited_server():
+    _RateLimited.hits = 0
+    server = HTTPServer(('127.0.0.1', 0), _RateLimited)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/v1/"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def coordination_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_budget, 'COORDINATION_FILE', str(tmp_path / 'coordination.db'))
+    monkeypatch.setattr(shared_budget, '_schema_ready', False)
+
+
+def test_each_429_attempt_hits_upstream_once(rate_limited_server, coordination_db, monkeypatch):
+    monkeypatch.setattr(shared_budget, 'MAX_429_RETRIES', 1)
+    reported = []
+    real_report = shared_budget.report_retry_after
+    monkeypatch.setattr(shared_budget, 'report_retry_after',
+                        lambda seconds: (reported.append(seconds), real_report(seconds)))
+
+    sp = shared_budget.BudgetedSpotify(auth='test-token')
+    sp.prefix = rate_limited_server
+
+    with pytest.raises(SpotifyException) as excinfo:
+        sp._get('tracks/abc')
+
+    attempts = shared_budget.MAX_429_RETRIES + 1
+    assert excinfo.value.http_status == 429
+    assert _RateLimited.hits == attempts
+    # Every attempt but the last publishes the real Retry-After value
+    assert reported == [1.0] * (attempts - 1)
@@ -2,7 +2,13 @@
 Smart transition algorithms and recommendation logic
 """
 import logging
-from spotify_client import get_track_features, search_tracks, get_recommendations
+import database
+import preview_index
+import profiling
+import artist_pool
+import compatibility
+import feature_matrix
+from spotify_client import get_track_features, get_tracks_features, multi_search, get_recommendations, get_related_artists
 
 def smart_transition_algorithm(sp, track_ids):
     """
@@ -27,33 +33,39 @@ def smart_transition_algorithm(sp, track_ids):
         if not track1 or not track2:
             return {"error": "Could not fetch track details"}, 500
 
+        # Keep names next to the cataloged features for bridge lookups
+        for track in (track1, track2):
+            artist_name = track["artists"][0]["name"] if track.get("artists") else None
+            database.save_catalog_track(track["id"], track_name=track["name"], artist_name=artist_name)
+
         logging.info(f"Finding transition between '{track1['name']}' and '{track2['name']}'")
 
         # Strategy 1: Related Artists
+        profiling.tag("smart:Related Artists")
         if len(suggestions) < 15:
             try:
                 artist1_id = track1["artists"][0]["id"]
                 artist2_id = track2["artists"][0]["id"]
                 
-                related1 = sp.artist_related_artists(artist1_id)["artists"][:3]
-                related2 = sp.artist_related_artists(artist2_id)["artists"][:3]
+                # Both return [] straight away while the endpoint's circuit is open
+                related1 = get_related_artists(sp, artist1_id)[:3]
+                related2 = get_related_artists(sp, artist2_id)[:3]
                 
                 for artist in related1 + related2:
                     try:
-                        albums = sp.artist_albums(artist["id"], limit=2)["items"]
-                        for album in albums:
-                            tracks = sp.album_tracks(album["id"], limit=3)["items"]
-                            for track in tracks:
-                                if track["id"] not in existing_ids and len(suggestions) < 15:
-                                    suggestions.append({
-                                        "id": track["id"],
-                                        "name": track["name"],
-                                        "artist": track["artists"][0]["name"],
-                                        "preview_url": track.get("preview_url"),
-                                        "strategy": "Related Artist",
-                                        "popularity": sp.track(track["id"]).get("popularity", 0)
-                                    })
-                                    existing_ids.add(track["id"])
+                        # Top tracks already carry popularity and previews: one cached call per artist
+                        pool = artist_pool.get_artist_pool(sp, artist["id"], artist.get("name"))
+                        for track in pool[:6]:
+                            if track["id"] not in existing_ids and len(suggestions) < 15:
+                                suggestions.append({
+                                    "id": track["id"],
+                                    "name": track["name"],
+                                    "artist": track["artist"],
+                                    "preview_url": track.get("preview_url"),
+                                    "strategy": "Related Artist",
+                                    "popularity": track.get("popularity", 0)
+                                })
+                                existing_ids.add(track["id"])
                     except Exception as e:
                         logging.warning(f"Related artist search failed: {str(e)}")
                         continue
@@ -65,25 +77,34 @@ def smart_transition_algorithm(sp, track_ids):
                 logging.warning(f"Related artists strategy failed: {str(e)}")
 
         # Strategy 2: Album-based recommendations
+        profiling.tag("smart:Album Exploration")
         if len(suggestions) < 15:
             try:
-                album1_id = track1["album"]["id"]
-                album2_id = track2["album"]["id"]
+                album_ids = list(dict.fromkeys([track1["album"]["id"], track2["album"]["id"]]))
                 
-                for album_id in [album1_id, album2_id]:
+                # Albums that keep coming back without previews are tried last
+                for album_id in preview_index.rank_sources("album", album_ids):
                     try:
                         album_tracks = sp.album_tracks(album_id, limit=10)["items"]
                         for track in album_tracks:
                             if track["id"] not in existing_ids and len(suggestions) < 15:
+                                popularity = 0
+                                # Popularity only orders tracks with a preview, so
+                                # skip the lookup for tracks known to have none
+                                if track.get("preview_url") or preview_index.lookup(track["id"]) is not False:
+                                    full_track = sp.track(track["id"])
+                                    popularity = full_track.get("popularity", 0)
+                                    track["preview_url"] = track.get("preview_url") or full_track.get("preview_url")
                                 suggestions.append({
                                     "id": track["id"],
                                     "name": track["name"],
                                     "artist": track["artists"][0]["name"],
                                     "preview_url": track.get("preview_url"),
                                     "strategy": "Same Album",
-                                    "popularity": sp.track(track["id"]).get("popularity", 0)
+                                    "popularity": popularity
                                 })
                                 existing_ids.add(track["id"])
+                        preview_index.record_tracks(album_tracks, "Same Album", "album", album_id)
                     except Exception as e:
                         continue
                         
@@ -94,6 +115,7 @@ def smart_transition_algorithm(sp, track_ids):
                 logging.warning(f"Album strategy failed: {str(e)}")
 
         # Strategy 3: Genre and audio feature matching (using search fallback)
+        profiling.tag("smart:Audio Features")
         if len(suggestions) < 15:
             try:
                 # First try the recommendations API
@@ -115,21 +137,24 @@ def smart_transition_algorithm(sp, track_ids):
                         target_danceability=avg_danceability
                     )
                     
-                    if recommendations and recommendations.get("tracks"):
-                        for track in recommendations["tracks"]:
-                            if track["id"] not in existing_ids and len(suggestions) < 15:
-                                suggestions.append({
-                                    "id": track["id"],
-                                    "name": track["name"],
-                                    "artist": track["artists"][0]["name"],
-                                    "preview_url": track.get("preview_url"),
-                                    "strategy": "Audio Features Match",
-                                    "popularity": track.get("popularity", 0)
-                                })
-                                existing_ids.add(track["id"])
-                        
-                        if len([s for s in suggestions if s["strategy"] == "Audio Features Match"]) > 0:
-                            strategies_used.append("Audio Features")
+                    # Failures and an open circuit both come back empty: use the fallback
+                    if not recommendations.get("tracks"):
+                        raise LookupError("No recommendations returned")
+                    
+                    for track in recommendations["tracks"]:
+                        if track["id"] not in existing_ids and len(suggestions) < 15:
+                            suggestions.append({
+                                "id": track["id"],
+                                "name": track["name"],
+                                "artist": track["artists"][0]["name"],
+                                "preview_url": track.get("preview_url"),
+                                "strategy": "Audio Features Match",
+                                "popularity": track.get("popularity", 0)
+                            })
+                            existing_ids.add(track["id"])
+                    
+                    if len([s for s in suggestions if s["strategy"] == "Audio Features Match"]) > 0:
+                        strategies_used.append("Audio Features")
                 except:
                     # Fallback to genre-based search if recommendations API fails
                     logging.info("Recommendations API failed, using genre-based search fallback")
@@ -143,10 +168,11 @@ def smart_transition_algorithm(sp, track_ids):
                     elif avg_tempo > 140:
                         genre_searches = ["fast songs", "electronic", "dance"] + genre_searches
                     
-                    for search_term in genre_searches[:3]:
+                    genre_results = multi_search(sp, genre_searches[:3], limit=4, exclude=existing_ids,
+                                                 target_count=15 - len(suggestions))
+                    for search_term, items in genre_results:
                         try:
-                            genre_results = search_tracks(sp, search_term, limit=4)
-                            for track in genre_results:
+                            for track in items:
                                 if track["id"] not in existing_ids and len(suggestions) < 15:
                                     suggestions.append({
                                         "id": track["id"],
@@ -167,13 +193,15 @@ def smart_transition_algorithm(sp, track_ids):
                 logging.warning(f"Audio features strategy failed: {str(e)}")
 
         # Strategy 4: Popular tracks in similar style
+        profiling.tag("smart:Popular Tracks")
         if len(suggestions) < 10:
             try:
                 genre_searches = ["pop hits", "trending music", "indie favorites", "electronic dance"]
-                for search_term in genre_searches[:2]:  # Limit to avoid too many API calls
+                popular_results = multi_search(sp, genre_searches[:2], limit=5, exclude=existing_ids,  # Limit to avoid too many API calls
+                                               target_count=15 - len(suggestions))
+                for search_term, items in popular_results:
                     try:
-                        popular_results = search_tracks(sp, search_term, limit=5)
-                        for track in popular_results:
+                        for track in items:
                             if track["id"] not in existing_ids and len(suggestions) < 15:
                                 suggestions.append({
                                     "id": track["id"],
@@ -193,11 +221,29 @@ def smart_transition_algorithm(sp, track_ids):
             except Exception as e:
                 logging.warning(f"Popular search failed: {str(e)}")
 
-        # Sort suggestions by preview availability and popularity
+        # Previews known from the index count even when this response omitted them
+        preview_index.fill_previews(suggestions)
+        for strategy in set(s["strategy"] for s in suggestions):
+            preview_index.record_tracks([s for s in suggestions if s["strategy"] == strategy], strategy, "strategy", strategy)
+
+        # Sort suggestions by preview availability, harmonic fit and popularity
+        profiling.tag("smart:Ranking")
+        candidate_ids = [s["id"] for s in suggestions]
+        uncatalogued = set(candidate_ids) - set(feature_matrix.get_features_bulk(candidate_ids))
+        if uncatalogued:
+            # One bulk call through the audio_features breaker; results land in the catalog
+            get_tracks_features(sp, uncatalogued)
+        fit = compatibility.bridge_scores(track1_id, track2_id, candidate_ids)
+        for suggestion in suggestions:
+            if suggestion["id"] in fit:
+                suggestion["compatibility"] = round(fit[suggestion["id"]], 4)
+        # Unscored tracks rank as average, so a few scored ones can't jump the queue
+        neutral_fit = sum(fit.values()) / len(fit) if fit else 0
         suggestions.sort(key=lambda x: (
-            x.get("preview_url") is not None,  # Preview tracks first
-            x.get("popularity", 0),            # Then by popularity
-            x.get("name", "").lower()          # Then alphabetically
+            x.get("preview_url") is not None,      # Preview tracks first
+            x.get("compatibility", neutral_fit),   # Then by key/tempo/energy fit with both seeds
+            x.get("popularity", 0),                # Then by popularity
+            x.get("name", "").lower()              # Then alphabetically
         ), reverse=True)
         
         # Limit to top 8 suggestions
@@ -241,13 +287,14 @@ def basic_transition_algorithm(sp, track_ids):
         existing_ids = set(track_ids)
 
         # Strategy 1: Search by artists
+        profiling.tag("basic:Artist Search")
         try:
             artist1_name = track1["artists"][0]["name"]
             artist2_name = track2["artists"][0]["name"]
             
             # Search for tracks by both artists
-            for artist_name in [artist1_name, artist2_name]:
-                search_results = search_tracks(sp, f"artist:{artist_name}", limit=5)
+            artist_queries = [f"artist:{artist_name}" for artist_name in [artist1_name, artist2_name]]
+            for query, search_results in multi_search(sp, artist_queries, limit=5, exclude=existing_ids, target_count=8):
                 for track in search_results:
                     if track["id"] not in existing_ids and len(suggestions) < 8:
                         suggestions.append({
@@ -261,6 +308,7 @@ def basic_transition_algorithm(sp, track_ids):
             logging.warning(f"Artist search failed: {str(e)}")
 
         # Strategy 2: Search by genre/style keywords
+        profiling.tag("basic:Genre Search")
         if len(suggestions) < 8:
             try:
                 # Extract keywords from track names for genre guessing
@@ -270,8 +318,9 @@ def basic_transition_algorithm(sp, track_ids):
                 # Common genre keywords to search for
                 genre_keywords = ["pop", "rock", "dance", "electronic", "indie", "hip hop"]
                 
-                for keyword in genre_keywords[:3]:  # Limit to avoid too many API calls
-                    search_results = search_tracks(sp, keyword, limit=3)
+                keyword_results = multi_search(sp, genre_keywords[:3], limit=3, exclude=existing_ids,  # Limit to avoid too many API calls
+                                               target_count=8 - len(suggestions))
+                for keyword, search_results in keyword_results:
                     for track in search_results:
                         if track["id"] not in existing_ids and len(suggestions) < 8:
                             suggestions.append({
@@ -285,11 +334,13 @@ def basic_transition_algorithm(sp, track_ids):
                 logging.warning(f"Genre search failed: {str(e)}")
 
         # Strategy 3: Popular tracks fallback
+        profiling.tag("basic:Popular Fallback")
         if len(suggestions) < 6:
             try:
                 popular_searches = ["top hits", "viral songs", "trending now"]
-                for search_term in popular_searches[:2]:
-                    search_results = search_tracks(sp, search_term, limit=3)
+                popular_results = multi_search(sp, popular_searches[:2], limit=3, exclude=existing_ids,
+                                               target_count=8 - len(suggestions))
+                for search_term, search_results in popular_results:
                     for track in search_results:
                         if track["id"] not in existing_ids and len(suggestions) < 8:
                             suggestions.append({
@@ -303,6 +354,9 @@ def basic_transition_algorithm(sp, track_ids):
                 logging.warning(f"Popular search failed: {str(e)}")
 
         # Sort by preview availability
+        profiling.tag("basic:Ranking")
+        preview_index.fill_previews(suggestions)
+        preview_index.record_tracks(suggestions, "Basic Search", "strategy", "Basic Search")
         suggestions.sort(key=lambda x: x.get("preview_url") is not None, reverse=True)
         
         logging.info(f"Basic transition found {len(suggestions)} suggestions using search-based approach")
@@ -0,0 +1,71 @@
+"""
+Boot-time cache warm-up: popular-tracks snapshot, hot tracks' features and settings
+"""
+import logging
+import threading
+import time
+
+import database
+import http_cache
+
+_lock = threading.Lock()
+_status = {
+    'status': 'idle',
+    'completed': 0,
+    'total': 0,
+    'failed': [],
+    'duration_ms': None
+}
+
+def get_status():
+    """Snapshot of warm-up progress for the readiness endpoint"""
+    with _lock:
+        status = dict(_status, failed=list(_status['failed']))
+    status['complete'] = status['status'] == 'done' and not status['failed']
+    return status
+
+def _warm_paths(hot_limit):
+    paths = ['/api/popular_tracks']
+    for track_id in database.get_hot_track_ids(hot_limit):
+        paths.append(f'/api/track_features/{track_id}')
+        paths.append(f'/api/get_settings/{track_id}')
+    return paths
+
+def warm_caches(app, hot_limit=20):
+    """
+    Issue internal GETs for the hot routes so their responses land in the HTTP
+    cache before real traffic asks for them. Failures are recorded, not raised.
+    """
+    started = time.perf_counter()
+    with _lock:
+        _status.update(status='running', completed=0, total=0, failed=[], duration_ms=None)
+
+    try:
+        paths = _warm_paths(hot_limit)
+        with _lock:
+            _status['total'] = len(paths)
+
+        client = app.test_client()
+        for path in paths:
+            try:
+                response = client.get(path)
+                # A placeholder response is not stored, so it does not count as warmed
+                ok = response.status_code == 200 and http_cache.FALLBACK_HEADER not in response.headers
+            except Exception as e:
+                logging.warning(f"Warm-up request {path} failed: {str(e)}")
+                ok = False
+            with _lock:
+                _status['completed'] += 1
+                if not ok:
+                    _status['failed'].append(path)
+
+        with _lock:
+            _status['status'] = 'done'
+    except Exception as e:
+        logging.error(f"Cache warm-up failed: {str(e)}")
+        with _lock:
+            _status['status'] = 'failed'
+    finally:
+        with _lock:
+            _status['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        logging.info(f"Cache warm-up finished: {get_status()}")